@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Reduces the number of readings written for slow-moving sensors.
+
+Two stages can be enabled per sensor:
+
+* window: readings are summarised over tumbling windows of `window` seconds
+  (aligned to the epoch) into one point with value (mean), min, max and count
+  fields, stamped with the start of the window;
+* deadband: a point is only written when its value differs from the last
+  written one by at least `deadband`, or when `heartbeat` seconds have passed
+  since the last written point.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HEARTBEAT = 300
+
+
+class SensorAggregator(object):
+    """
+    Turns (value, timestamp) readings of one sensor into the points to
+    write, (value, timestamp, line-protocol record) tuples. Timestamps are in
+    milliseconds.
+    """
+    def __init__(self, encoder, window=0, deadband=0,
+                 heartbeat=DEFAULT_HEARTBEAT):
+        self.encoder = encoder
+        self.window = int(float(window) * 1000)
+        self.deadband = float(deadband)
+        self.heartbeat = int(float(heartbeat) * 1000)
+        self._window_start = None
+        self._count = 0
+        self._total = 0.0
+        self._min = None
+        self._max = None
+        self._last_value = None
+        self._last_timestamp = None
+
+    def add(self, value, timestamp):
+        """Returns the point to write for this reading, or None."""
+        if not self.window:
+            return self._filter(value, timestamp, None)
+
+        window_start = timestamp - timestamp % self.window
+        point = None
+        if self._count and window_start != self._window_start:
+            point = self.flush()
+
+        if not self._count:
+            self._window_start = window_start
+            self._min = self._max = value
+        elif value < self._min:
+            self._min = value
+        elif value > self._max:
+            self._max = value
+        self._count += 1
+        self._total += value
+
+        return point
+
+    def flush(self):
+        """Returns the point for the current, incomplete window, or None."""
+        if not self._count:
+            return None
+
+        summary = (self._total / self._count, self._min, self._max,
+                   self._count)
+        self._count = 0
+        self._total = 0.0
+
+        return self._filter(summary[0], self._window_start, summary)
+
+    def _filter(self, value, timestamp, summary):
+        if self.deadband and self._last_value is not None and \
+                abs(value - self._last_value) < self.deadband and \
+                timestamp - self._last_timestamp < self.heartbeat:
+            return None
+
+        self._last_value = value
+        self._last_timestamp = timestamp
+        if summary is None:
+            line = self.encoder.encode(value, timestamp)
+        else:
+            line = self.encoder.encode_summary(*summary, timestamp=timestamp)
+        return value, timestamp, line
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of influx-temperature.py without a Pi or an InfluxDB.
+
+Usage: bench-collector.py [-n <counts>] [-c <seconds>] [-t <seconds>]
+                          [-b <size>] [-a <seconds>] [-e <engine>] [-v]
+
+Options:
+    -n <counts>   Comma-separated numbers of sensors to benchmark
+                  [default: 1,10,100].
+    -c <seconds>  Conversion delay of each fake sensor [default: 0.75].
+    -t <seconds>  Duration of each run [default: 20].
+    -b <size>     Batch size written by the collector [default: 100].
+    -a <seconds>  Maximum batch age of the collector [default: 2].
+    -e <engine>   Collector reader engine [default: sysfs].
+    -v            Show the collector's log output.
+    -h, --help    Print help.
+
+Each run creates a fake w1 devices tree whose w1_slave attributes are named
+pipes; a reader blocks for the conversion delay just like on a real bus. A
+local HTTP server stands in for InfluxDB and records requests, bytes, write
+latency and the lag between each reading's timestamp and its arrival. The
+collector runs as a child process so its CPU time can be measured on its own.
+"""
+import gzip
+import http.server
+import json
+import os
+import random
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from docopt import docopt
+
+COLLECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'influx-temperature.py')
+
+
+class FakeW1Devices(object):
+    """
+    A w1 devices directory with `count` DS18B20 sensors. Each w1_slave is a
+    FIFO served by a thread that answers every open after `delay` seconds.
+    """
+    def __init__(self, count, delay):
+        self.delay = delay
+        self._tmp = tempfile.TemporaryDirectory(prefix='fake-w1-')
+        self.path = self._tmp.name
+        self._stopping = threading.Event()
+        self._fifos = []
+        for index in range(count):
+            device = os.path.join(self.path, '28-{:012x}'.format(index + 1))
+            os.mkdir(device)
+            fifo = os.path.join(device, 'w1_slave')
+            os.mkfifo(fifo)
+            self._fifos.append(fifo)
+            threading.Thread(target=self._serve, args=(fifo,),
+                             daemon=True).start()
+
+    def _serve(self, fifo):
+        while not self._stopping.is_set():
+            fd = os.open(fifo, os.O_WRONLY)
+            try:
+                time.sleep(self.delay)
+                millidegrees = random.randint(18000, 24000)
+                os.write(fd, '72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+                             '72 01 4b 46 7f ff 0e 10 57 t={}\n'.format(
+                                 millidegrees).encode('ascii'))
+            except BrokenPipeError:
+                pass
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self._stopping.set()
+        for fifo in self._fifos:
+            # releases the serving thread blocked on opening its FIFO
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        self._tmp.cleanup()
+
+
+class FakeInfluxDB(http.server.ThreadingHTTPServer):
+    """Accepts /write and /query and records what it was sent."""
+    def __init__(self):
+        super(FakeInfluxDB, self).__init__(('127.0.0.1', 0), FakeHandler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.readings = 0
+        self.latencies = []
+        self.lags = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, wire_bytes, lines, latency):
+        now = time.time() * 1000
+        lags = [now - int(line.rsplit(' ', 1)[1]) for line in lines
+                if line.startswith('temperature')]
+        with self.lock:
+            self.requests += 1
+            self.bytes += wire_bytes
+            self.readings += len(lags)
+            self.latencies.append(latency)
+            self.lags.extend(lags)
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'results': [{'series': [{
+            'name': 'databases', 'columns': ['name'],
+            'values': [['default']]}]}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.startswith('/query'):
+            return self.do_GET()
+
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        data = body
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(body)
+        lines = data.decode('utf-8').splitlines()
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.server.record(len(body), lines, time.perf_counter() - start)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def write_config(directory, port, batch_size, batch_age):
+    path = os.path.join(directory, 'influxdb-config.yaml')
+    with open(path, 'w') as fh:
+        fh.write('host: 127.0.0.1\nport: {port}\ntimeout: 5\nretries: 1\n'
+                 'batch:\n  size: {batch_size}\n  max_age: {batch_age}\n'
+                 .format(**locals()))
+    return path
+
+
+def run(count, options):
+    devices = FakeW1Devices(count, float(options['-c']))
+    influx = FakeInfluxDB()
+    influx.thread.start()
+    config = write_config(devices.path, influx.port, options['-b'],
+                          options['-a'])
+    command = [sys.executable, COLLECTOR, '-e', options['-e'],
+               '-w', devices.path, '-i', config, '-m',
+               os.path.join(devices.path, 'no-sensors.yaml'),
+               '-p', str(count), '-t', '0']
+    output = None if options['-v'] else subprocess.DEVNULL
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    collector = subprocess.Popen(command, stdout=output, stderr=output)
+    time.sleep(float(options['-t']))
+    collector.send_signal(signal.SIGINT)
+    collector.wait()
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    influx.shutdown()
+    devices.close()
+
+    cpu = (usage_after.ru_utime - usage_before.ru_utime +
+           usage_after.ru_stime - usage_before.ru_stime)
+    readings = influx.readings or float('nan')
+    print('{count:>4} sensors: {rate:8.1f} readings/s, lag median '
+          '{lag_median:6.0f} ms p95 {lag_p95:6.0f} ms, {cpu_us:8.0f} µs '
+          'CPU/reading, {requests} requests, {bytes_per:5.1f} B/reading, '
+          'write p95 {write_p95:5.2f} ms'.format(
+              count=count, rate=influx.readings / float(options['-t']),
+              lag_median=statistics.median(influx.lags or [float('nan')]),
+              lag_p95=percentile(influx.lags, 0.95),
+              cpu_us=cpu / readings * 1e6, requests=influx.requests,
+              bytes_per=influx.bytes / readings,
+              write_p95=percentile(influx.latencies, 0.95) * 1000))
+
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+    for count in options['-n'].split(','):
+        run(int(count), options)
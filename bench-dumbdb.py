@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares the DumbDB backends at increasing numbers of IDs.
+
+Usage: bench-dumbdb.py [-n <counts>] [-b <backends>] [-l <lookups>]
+
+Options:
+    -n <counts>    Comma-separated numbers of IDs [default: 10000,100000,1000000].
+    -b <backends>  Comma-separated backends to compare [default: text,dbm,sqlite].
+    -l <lookups>   Lookups per measurement, half hits and half misses
+                   [default: 100000].
+    -h, --help     Print help.
+
+For each backend and count a database is filled in a temporary directory with
+add_many, then reopened. Reported are: bulk insert rate, open time, lookup
+rate with exists and exists_many, and the rate of single adds that commit
+every 1000 IDs.
+"""
+import os
+import random
+import tempfile
+import time
+
+from docopt import docopt
+
+from dumbdb import DumbDB
+
+SUFFIXES = {'text': '.txt', 'dbm': '.dbm', 'sqlite': '.db'}
+SINGLE_ADDS = 10000
+
+
+def rate(count, seconds):
+    return '{:>10.0f}/s'.format(count / seconds if seconds else float('inf'))
+
+
+def bench(backend, count, lookups, directory):
+    path = os.path.join(directory, 'bench-{}{}'.format(
+        count, SUFFIXES[backend]))
+    ids = ['{:08d}'.format(index) for index in range(count)]
+
+    start = time.perf_counter()
+    with DumbDB(path) as db:
+        db.add_many(ids)
+    bulk = time.perf_counter() - start
+
+    start = time.perf_counter()
+    db = DumbDB(path, sync_every=1000)
+    opened = time.perf_counter() - start
+
+    keys = random.sample(ids, min(lookups // 2, count)) + [
+        'missing-{}'.format(index) for index in range(lookups // 2)]
+    random.shuffle(keys)
+    start = time.perf_counter()
+    for key in keys:
+        db.exists(key)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    db.exists_many(keys)
+    many = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for index in range(SINGLE_ADDS):
+        db.add('new-{}'.format(index))
+    db.sync()
+    adds = time.perf_counter() - start
+    db.close()
+
+    print('{:>6} {:>8} IDs: add_many {}, open {:8.1f} ms, exists {}, '
+          'exists_many {}, add {}'.format(
+              backend, count, rate(count, bulk), opened * 1000,
+              rate(len(keys), single), rate(len(keys), many),
+              rate(SINGLE_ADDS, adds)), flush=True)
+
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+    counts = [int(count) for count in options['-n'].split(',')]
+    backends = options['-b'].split(',')
+    lookups = int(options['-l'])
+
+    with tempfile.TemporaryDirectory(prefix='bench-dumbdb-') as directory:
+        for count in counts:
+            for backend in backends:
+                bench(backend, count, lookups, directory)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares line-protocol formatting throughput of the per-reading formatter
+influx-temperature.py used to have with the precompiled SensorEncoder.
+
+Usage: bench-lineprotocol.py [-n <readings>]
+
+Options:
+    -n <readings>  Number of readings formatted per run [default: 200000].
+    -h, --help     Print help.
+"""
+import logging
+import timeit
+
+from docopt import docopt
+
+from lineprotocol import SensorEncoder
+
+METADATA = {'location': 'bedroom 1', 'floor': 'first', 'scale': 'f'}
+TEMPERATURES = (21.375, 70.475, 294.525)
+TIMESTAMP = 1561900000000
+
+
+def legacy_temperature_in_scale(temperatures_cfk, scale):
+    scale = scale or 'c'
+    if scale.lower().startswith('c'):
+        temperature = temperatures_cfk[0]
+    elif scale.lower().startswith('f'):
+        temperature = temperatures_cfk[1]
+    elif scale.lower().startswith('k'):
+        temperature = temperatures_cfk[2]
+    else:
+        temperature = temperatures_cfk[0]
+
+    return temperature
+
+
+def legacy_format_measurement_tags(metadata):
+    tags = ''
+    for meta_name, meta_value in metadata.items():
+        tags += ',{meta_name}={meta_value}'.format(**locals())
+
+    return tags
+
+
+def legacy_format_measurement(sensor_id, metadata, temp_all_units, timestamp):
+    value = legacy_temperature_in_scale(temp_all_units, metadata.get('scale'))
+    tags = legacy_format_measurement_tags(metadata)
+    template = ('temperature,sensor_id={sensor_id}{tags} value={value} '
+                '{timestamp}')
+    return template.format(**locals())
+
+
+def encoder_format_measurement(encoder, temp_all_units, timestamp):
+    return encoder.encode(encoder.value(temp_all_units), timestamp)
+
+
+def report(name, readings, seconds):
+    print('{name:>10}: {rate:>12,.0f} readings/s '
+          '({usec:.2f} µs/reading)'.format(
+              name=name, rate=readings / seconds,
+              usec=seconds / readings * 1e6))
+
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+    logging.basicConfig(level=logging.WARNING)
+    readings = int(options['-n'])
+    encoder = SensorEncoder('011551c3b1ff', METADATA)
+
+    print('legacy:  {}'.format(legacy_format_measurement(
+        '011551c3b1ff', METADATA, TEMPERATURES, TIMESTAMP)))
+    print('encoder: {}'.format(encoder_format_measurement(
+        encoder, TEMPERATURES, TIMESTAMP)))
+
+    legacy = min(timeit.repeat(
+        lambda: legacy_format_measurement(
+            '011551c3b1ff', METADATA, TEMPERATURES, TIMESTAMP),
+        number=readings, repeat=3))
+    compiled = min(timeit.repeat(
+        lambda: encoder_format_measurement(encoder, TEMPERATURES, TIMESTAMP),
+        number=readings, repeat=3))
+
+    report('legacy', readings, legacy)
+    report('encoder', readings, compiled)
+    print('speed-up: {:.1f}x'.format(legacy / compiled))
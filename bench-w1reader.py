@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares start-up time and per-read latency of the sysfs reader engine with
+the w1thermsensor package.
+
+Usage: bench-w1reader.py [-d <path> | -f <n>] [-n <reads>]
+
+Options:
+    -d <path>   w1 devices directory [default: /sys/bus/w1/devices].
+    -f <n>      Benchmark against <n> fake sensors in a temporary directory
+                instead; measures parsing and syscall overhead only.
+    -n <reads>  Number of reads per sensor and engine [default: 20].
+    -h, --help  Print help.
+
+Reads from real sensors include the ~750 ms conversion time of each DS18B20,
+so use -f to compare the engines' own overhead.
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+W1_SLAVE = ('72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+            '72 01 4b 46 7f ff 0e 10 57 t=23125\n')
+
+
+class Handle(object):
+    """Minimal stand-in for w1sensors.SensorHandle reading in Celsius."""
+    class encoder(object):
+        scale_index = 0
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.id = sensor.id
+
+
+def make_fake_devices(directory, count):
+    for index in range(count):
+        device = os.path.join(directory, '28-{:012x}'.format(index + 1))
+        os.makedirs(device)
+        with open(os.path.join(device, 'w1_slave'), 'w') as fh:
+            fh.write(W1_SLAVE)
+
+
+def report(name, startup, latencies):
+    print('{name:>14}: start-up {startup:8.2f} ms, read median '
+          '{median:8.1f} µs, p95 {p95:8.1f} µs'.format(
+              name=name, startup=startup * 1000,
+              median=statistics.median(latencies) * 1e6,
+              p95=sorted(latencies)[int(len(latencies) * 0.95)] * 1e6))
+
+
+def time_reads(read, sensors, reads):
+    latencies = []
+    for _ in range(reads):
+        for sensor in sensors:
+            start = time.perf_counter()
+            read(sensor)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_sysfs(devices_path, reads):
+    start = time.perf_counter()
+    from w1sensors import SysfsReader
+    reader = SysfsReader(devices_path)
+    handles = [Handle(sensor) for sensor in reader.discover()]
+    startup = time.perf_counter() - start
+
+    report('sysfs', startup, time_reads(reader.read, handles, reads))
+    return len(handles)
+
+
+def bench_w1thermsensor(devices_path, reads):
+    start = time.perf_counter()
+    os.environ['W1THERMSENSOR_NO_KERNEL_MODULE'] = '1'
+    try:
+        import w1thermsensor
+    except ImportError:
+        print('w1thermsensor not installed; skipped.', file=sys.stderr)
+        return
+    w1thermsensor.W1ThermSensor.BASE_DIRECTORY = devices_path
+    sensors = w1thermsensor.W1ThermSensor.get_available_sensors()
+    startup = time.perf_counter() - start
+
+    units = [w1thermsensor.W1ThermSensor.DEGREES_C,
+             w1thermsensor.W1ThermSensor.DEGREES_F,
+             w1thermsensor.W1ThermSensor.KELVIN]
+    report('w1thermsensor', startup, time_reads(
+        lambda sensor: sensor.get_temperatures(units), sensors, reads))
+
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+    reads = int(options['-n'])
+
+    if options['-f']:
+        fake_dir = tempfile.TemporaryDirectory()
+        make_fake_devices(fake_dir.name, int(options['-f']))
+        devices_path = fake_dir.name
+    else:
+        devices_path = options['-d']
+
+    if not bench_sysfs(devices_path, reads):
+        print('No sensors found in {}'.format(devices_path), file=sys.stderr)
+        sys.exit(1)
+    bench_w1thermsensor(devices_path, reads)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Sensor sampling loop shared by influx-temperature.py and ds18b20.py.
+
+Every sensor is read once per interval and each reading is handed to
+`readings`, any object with a `put` method, as a Reading. sinks.FanOut
+delivers them to as many outputs as are configured.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import sys
+import time
+
+from lineprotocol import timestamp_now
+from scheduler import Scheduler
+from stats import Stats, StatsReporter
+from supervisor import bus_shards, group_shards
+from w1sensors import (
+    CRCError, DevicesWatcher, SensorReadError, SensorRegistry, SysfsReader,
+    W1ThermSensorReader)
+
+log = logging.getLogger(__name__)
+
+# upper bound on reader threads when reading all sensors at once
+MAX_READ_WORKERS = 64
+# longest sleep between collection cycles, so registry changes and worker
+# heartbeats are noticed even when all sensors have long intervals
+MAX_IDLE = 1
+
+# a point to write; sensor_id is None for records such as collector_stats
+# that only InfluxDB outputs understand
+Reading = collections.namedtuple(
+    'Reading', 'sensor_id tags value timestamp line')
+
+
+def record(line):
+    return Reading(None, None, None, None, line)
+
+
+def initialise_w1thermsensor():
+    os.environ['W1THERMSENSOR_NO_KERNEL_MODULE'] = '1'
+    from w1thermsensor.errors import KernelModuleLoadError
+    del os.environ['W1THERMSENSOR_NO_KERNEL_MODULE']
+
+    try:
+        import w1thermsensor
+        w1thermsensor.core.load_kernel_modules()
+        return w1thermsensor.W1ThermSensor()
+    except KernelModuleLoadError:
+        log.error('Module w1thermsensor could not load required kernel '
+                  'modules. Run as root or load them yourself.')
+        return None
+
+
+def sensor_reader(engine, devices_path):
+    if engine == 'sysfs':
+        return SysfsReader(devices_path)
+
+    if engine == 'w1thermsensor':
+        w1client = initialise_w1thermsensor()
+        if w1client is None:
+            return None
+        return W1ThermSensorReader(w1client)
+
+    log.error('Unknown reader engine "{}".'.format(engine))
+    return None
+
+
+def is_valid_reading(value):
+    if value < -10 or value > 60:
+        return False
+    return True
+
+
+def read_sensor(reader, handle, stats):
+    start = time.perf_counter()
+    try:
+        value = reader.read(handle)
+    except CRCError as e:
+        log.error('Could not read sensor "{}": {}'.format(handle.id, e))
+        stats.count('crc_errors', handle.id)
+        value = None
+    except SensorReadError as e:
+        log.error('Could not read sensor "{}": {}'.format(handle.id, e))
+        stats.count('read_errors', handle.id)
+        value = None
+    stats.observe('read_seconds', time.perf_counter() - start, handle.id)
+    return handle, value, timestamp_now()
+
+
+def read_sensors(reader, handles, executor, stats):
+    """
+    Reads all sensors through `executor` so their conversions overlap; a cycle
+    takes roughly one conversion time when there are enough workers.
+    """
+    return executor.map(
+        lambda handle: read_sensor(reader, handle, stats), handles)
+
+
+def read_workers(parallel):
+    parallel = int(parallel)
+    if parallel <= 0:
+        return MAX_READ_WORKERS
+    return parallel
+
+
+def put_point(readings, handle, point):
+    value, timestamp, line = point
+    log.debug('Formatted record: "%s"', line)
+    readings.put(Reading(handle.id, handle.tags, value, timestamp, line))
+
+
+def flush_aggregators(registry, readings):
+    for handle in registry.sensors():
+        point = handle.aggregator.flush()
+        if point is not None:
+            put_point(readings, handle, point)
+
+
+def start_stats(stats, interval, readings, scheduler=None):
+    """
+    Reports `stats` as collector_stats records put into `readings` every
+    `interval` seconds; returns the started StatsReporter, or None if
+    `interval` is 0.
+    """
+    stats.gauge('queue_depth', lambda: len(readings))
+    stats.gauge('queue_dropped', lambda: readings.dropped)
+    if scheduler is not None:
+        stats.gauge('overruns', lambda: scheduler.overruns)
+
+    if interval <= 0:
+        return None
+
+    reporter = StatsReporter(
+        stats, lambda line: readings.put(record(line)), timestamp_now,
+        interval=interval)
+    reporter.start()
+    return reporter
+
+
+def temperature_collection_loop(reader, registry, readings, executor,
+                                scheduler, stats, beat=None):
+    while True:
+        due = scheduler.due(registry.sensors())
+        for handle, value, timestamp in read_sensors(
+                reader, due, executor, stats):
+            if value is None:
+                continue
+            if not is_valid_reading(value):
+                log.error('Ignored bad temperature from "{}": {}'.format(
+                    handle.id, value))
+                stats.count('invalid_readings', handle.id)
+                continue
+
+            start = time.perf_counter()
+            point = handle.aggregator.add(value, timestamp)
+            stats.observe('format_seconds', time.perf_counter() - start)
+            if point is not None:
+                put_point(readings, handle, point)
+
+        scheduler.complete(due)
+        if beat is not None:
+            beat()
+        scheduler.wait(maximum=MAX_IDLE)
+
+
+def collect(reader, devices_path, metadata, readings, stats, parallel=0,
+            refresh_interval=60, default_interval=1, stats_interval=60,
+            beat=None):
+    """Samples sensors into `readings` until interrupted."""
+    sensor_registry = SensorRegistry(
+        reader.discover, metadata, refresh_interval=refresh_interval,
+        watcher=DevicesWatcher(devices_path),
+        default_interval=default_interval)
+    scheduler = Scheduler()
+    stats_reporter = start_stats(stats, stats_interval, readings, scheduler)
+    read_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=read_workers(parallel), thread_name_prefix='w1-read')
+    try:
+        log.debug('Initialisation complete; entering collection loop.')
+        temperature_collection_loop(
+            reader, sensor_registry, readings, read_executor, scheduler,
+            stats, beat)
+    finally:
+        if stats_reporter is not None:
+            stats_reporter.stop()
+        read_executor.shutdown(wait=False)
+        flush_aggregators(sensor_registry, readings)
+
+
+def shard_reader(shard, engine):
+    reader = sensor_reader(engine, shard.devices_path)
+    if reader is None:
+        return None
+
+    discover = reader.discover
+    reader.discover = lambda: [
+        sensor for sensor in discover() if shard.includes(sensor.id)]
+    return reader
+
+
+def shard_worker(shard, heartbeat, readings, engine, metadata, settings):
+    """Supervisor target; `settings` are keyword arguments of `collect`."""
+    def beat():
+        heartbeat.value = time.monotonic()
+
+    reader = shard_reader(shard, engine)
+    if reader is None:
+        sys.exit(1)
+    stats = Stats(tags={'shard': shard.name})
+    try:
+        collect(reader, shard.devices_path, metadata, readings, stats,
+                beat=beat, **settings)
+    except KeyboardInterrupt:
+        pass
+
+
+def make_shards(shard_by, engine, devices_path):
+    if shard_by != 'bus':
+        return group_shards(int(shard_by), devices_path)
+
+    if engine != 'sysfs':
+        log.error('Sharding by bus master requires the sysfs engine.')
+        return []
+    shards = bus_shards(devices_path)
+    if not shards:
+        log.error('No 1-Wire bus masters found in {}.'.format(devices_path))
+    return shards
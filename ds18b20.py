@@ -1,65 +1,63 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
-import datetime
-import graphitesend
-import statsd
-import time
+import os
+import sys
 import RPi.GPIO as GPIO
 
-from graphitesend import GraphiteSendException
+from collector import collect
+from sinks import FanOut, make_outputs, read_sinks_config
+from stats import Stats
+from w1sensors import SysfsReader
 
 SENSORS = {
     'outside': '/sys/bus/w1/devices/28-041661c3b1ff/w1_slave',
     'inside': '/sys/bus/w1/devices/28-031661b1c7ff/w1_slave',
 }
 FILE_OUT = 'temperature.csv'
-
-try:
-    graphitesend.init(graphite_server='localhost')
-    GRAPHITE_OUT = True
-except GraphiteSendException:
-    GRAPHITE_OUT = False
-    print('Could not find Carbon. Not sending data to graphite.')
-
-
-GPIO.setmode(GPIO.BCM)
+# used unless a sinks file is given as the first argument
+SINKS = {
+    'csv': {'type': 'csv', 'path': FILE_OUT, 'daily': True},
+    'graphite': {'type': 'graphite', 'host': 'localhost', 'prefix': 'temp_'},
+    'stdout': {'type': 'stdout'},
+}
 
 
-def print_temperatures(sensors):
-    now = datetime.datetime.now().isoformat()
-    print('{}'.format(now))
+def sensor_metadata(sensors):
+    """{sensor_id: {'location': name}} for the devices in `sensors`."""
+    metadata = {}
     for name, sensor_path in sensors.items():
-        with open(sensor_path, 'r') as sensor_fh:
-            data = sensor_fh.readlines()
+        device = os.path.basename(os.path.dirname(sensor_path))
+        metadata[device.split('-', 1)[1]] = {'location': name}
 
-        if len(data) != 2:
-            print('Unexpected data read from sensor '
-                  '{name}:{data}'.format(**locals()))
-            continue
+    return metadata
 
-        for line in data:
-            if line.startswith('t='):
-                break
 
-        raw_temperature = int(line.split('=')[1])
-        temperature = raw_temperature / 1000
+def sensors_reader(sensors, metadata):
+    devices_path = os.path.dirname(os.path.dirname(
+        next(iter(sensors.values()))))
+    reader = SysfsReader(devices_path)
+    discover = reader.discover
+    reader.discover = lambda: [
+        sensor for sensor in discover() if sensor.id in metadata]
 
-        if GRAPHITE_OUT:
-            graphitesend.send('temp_' + name, temperature)
+    return reader
 
-        if FILE_OUT:
-            with open(FILE_OUT, 'a') as out_fh:
-                out_fh.write('{now},{name}={temperature}\n'.format(**locals()))
 
-        print('Sensor {name}: {temperature}°C'.format(**locals()))
+GPIO.setmode(GPIO.BCM)
 
+metadata = sensor_metadata(SENSORS)
+reader = sensors_reader(SENSORS, metadata)
+sinks = SINKS
+if len(sys.argv) > 1:
+    sinks = read_sinks_config(sys.argv[1])
+fanout = FanOut(make_outputs(sinks))
+fanout.start()
 
 try:
-    while True:
-        print_temperatures(SENSORS)
-        print()
-        time.sleep(1)
+    collect(reader, reader.devices_path, metadata, fanout, Stats(),
+            stats_interval=0)
 
 except KeyboardInterrupt:
+    fanout.stop()
     GPIO.cleanup()
     print("Program Exited Cleanly")
@@ -1,20 +1,437 @@
-class DumbDB(object):
-    def __init__(self, db_path):
+#!/usr/bin/env python3
+"""
+Usage: dumbdb.py migrate <source> <destination>
+
+Copies every ID from one DumbDB to another, e.g.:
+
+    dumbdb.py migrate downloaded_before.txt sqlite:///downloaded_before.db
+
+A DumbDB is chosen by path or URL: 'sqlite:///<path>' or a .db, .sqlite or
+.sqlite3 file is SQLite, 'dbm:///<path>' or a .dbm file is a dbm hash, and
+anything else ('text:///<path>') is a text file with one ID per line. As in
+other database URLs, the path after the third slash is relative, so an
+absolute path takes four: 'sqlite:////var/lib/ids.db'.
+"""
+import dbm
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+SUFFIXES = {
+    '.db': 'sqlite',
+    '.sqlite': 'sqlite',
+    '.sqlite3': 'sqlite',
+    '.dbm': 'dbm',
+}
+# values of an ID stored in columns of their own by the SQLite backend
+COLUMNS = ('timestamp', 'size')
+# parameters per query when checking many IDs in SQLite
+SQLITE_CHUNK = 500
+
+
+class TextBackend(object):
+    """
+    A set of IDs kept in a text file, one per line. The file is read into
+    memory once, so `exists` does not touch the disk, and new IDs are
+    appended through a single open handle. Values are not stored.
+
+    New IDs are written every `sync_every` adds, and also fsynced when
+    `fsync` is set; `close` (or leaving a `with` block) writes the rest.
+    Duplicate and blank lines are removed from the file when it is loaded.
+    Writes and compaction hold an flock on the file, so IDs appended by
+    other handles while it is compacted are kept.
+    """
+    def __init__(self, db_path, sync_every=1, fsync=False, compact=True):
         self.db_path = db_path
+        self.sync_every = sync_every
+        self.fsync = fsync
+        self.compact_on_load = compact
+        self._ids = set()
+        self._fh = None
+        self._pending = []
+        self.reload()
 
-    def add(self, resource_id):
-        with open(self.db_path, "a") as f:
-            f.write(str(resource_id))
-            f.write('\n')
+    def __len__(self):
+        return len(self._ids)
 
-    def exists(self, resource_id):
-        str_id = str(resource_id)
+    def __iter__(self):
+        return iter(self._ids)
+
+    @staticmethod
+    def _parse(f):
+        """({ID: None} in file order, number of lines) of an open file."""
+        ids = {}
+        lines = 0
+        for line in f:
+            lines += 1
+            str_id = line.strip()
+            if str_id:
+                ids[str_id] = None
+        return ids, lines
+
+    def _is_current(self, f):
+        """Whether `f` is still the file at db_path, i.e. not compacted."""
+        try:
+            return os.fstat(f.fileno()).st_ino == os.stat(self.db_path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _lock(self, f, mode):
+        """Locks `f`, or a reopened handle if it was replaced; returns it."""
+        while True:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if self._is_current(f):
+                return f
+            f.close()
+            f = open(self.db_path, mode)
+
+    def reload(self):
+        """Reads the file again, e.g. to see IDs added by other processes."""
+        self.close()
+        ids = {}
+        lines = 0
         try:
             with open(self.db_path, 'r') as f:
-                for line in f:
-                    if line.strip() == str_id:
-                        return True
+                ids, lines = self._parse(f)
         except FileNotFoundError:
             pass
 
-        return False
+        self._ids = set(ids)
+        if self.compact_on_load and lines != len(ids):
+            self._compact()
+
+    def _compact(self):
+        try:
+            f = open(self.db_path, 'r')
+        except FileNotFoundError:
+            return
+        f = self._lock(f, 'r')
+        with f:
+            # read again under the lock to keep what was appended since
+            ids, lines = self._parse(f)
+            self._ids = set(ids)
+            if lines == len(ids):
+                return
+
+            log.info('Compacting {}: {} IDs'.format(self.db_path, len(ids)))
+            temporary = self.db_path + '.tmp'
+            with open(temporary, 'w') as out:
+                for str_id in ids:
+                    out.write(str_id)
+                    out.write('\n')
+                out.flush()
+                os.fsync(out.fileno())
+            # handles waiting for the lock see the new file and reopen it
+            os.replace(temporary, self.db_path)
+
+    def add(self, resource_id, **values):
+        str_id = str(resource_id)
+        if str_id in self._ids:
+            return
+
+        self._pending.append(str_id + '\n')
+        self._ids.add(str_id)
+        if len(self._pending) >= self.sync_every:
+            self.sync()
+
+    def add_many(self, resource_ids):
+        new_ids = {}
+        for resource_id in resource_ids:
+            str_id = str(resource_id)
+            if str_id not in self._ids:
+                new_ids[str_id] = None
+        if not new_ids:
+            return
+
+        self._pending.extend(str_id + '\n' for str_id in new_ids)
+        self._ids.update(new_ids)
+        self.sync()
+
+    def sync(self):
+        if not self._pending:
+            return
+        if self._fh is None:
+            self._fh = open(self.db_path, 'a')
+        self._fh = self._lock(self._fh, 'a')
+        try:
+            self._fh.write(''.join(self._pending))
+            self._fh.flush()
+            if self.fsync:
+                os.fsync(self._fh.fileno())
+        finally:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+        self._pending = []
+
+    def close(self):
+        self.sync()
+        if self._fh is None:
+            return
+        self._fh.close()
+        self._fh = None
+
+    def exists(self, resource_id):
+        return str(resource_id) in self._ids
+
+    def exists_many(self, resource_ids):
+        ids = self._ids
+        return [str(resource_id) in ids for resource_id in resource_ids]
+
+    def get(self, resource_id):
+        return {} if self.exists(resource_id) else None
+
+
+class DbmBackend(object):
+    """
+    IDs as keys of a dbm hash, with their values as JSON. Nothing is read
+    up front, so opening does not depend on the number of IDs.
+
+    dbm has no separate fsync; its `sync` writes to disk where the module
+    supports it. With `fsync` every add is synced, whatever `sync_every`.
+    """
+    def __init__(self, db_path, sync_every=1, fsync=False, **kwargs):
+        self.db_path = db_path
+        self.sync_every = 1 if fsync else sync_every
+        self._db = dbm.open(db_path, 'c')
+        self._unsynced = 0
+
+    def __len__(self):
+        return len(self._db)
+
+    def __iter__(self):
+        return (key.decode('utf-8') for key in self._db.keys())
+
+    def reload(self):
+        pass
+
+    def add(self, resource_id, **values):
+        key = str(resource_id)
+        if key in self._db:
+            return
+        self._db[key] = json.dumps(values) if values else ''
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def add_many(self, resource_ids):
+        db = self._db
+        for resource_id in resource_ids:
+            key = str(resource_id)
+            if key not in db:
+                db[key] = ''
+        self.sync()
+
+    def sync(self):
+        if hasattr(self._db, 'sync'):
+            self._db.sync()
+        self._unsynced = 0
+
+    def close(self):
+        self._db.close()
+
+    def exists(self, resource_id):
+        return str(resource_id) in self._db
+
+    def exists_many(self, resource_ids):
+        db = self._db
+        return [str(resource_id) in db for resource_id in resource_ids]
+
+    def get(self, resource_id):
+        value = self._db.get(str(resource_id))
+        if value is None:
+            return None
+        return json.loads(value) if value else {}
+
+
+class SQLiteBackend(object):
+    """
+    IDs as the indexed key of an SQLite table in WAL mode, with 'timestamp'
+    and 'size' columns and any other values as JSON. Adds are committed
+    every `sync_every` IDs; with `fsync` every commit is made durable.
+    """
+    def __init__(self, db_path, sync_every=1, fsync=False, **kwargs):
+        self.db_path = db_path
+        self.sync_every = sync_every
+        self._db = sqlite3.connect(db_path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous={}'.format(
+            'FULL' if fsync else 'NORMAL'))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS ids (id TEXT PRIMARY KEY, '
+            'timestamp REAL, size INTEGER, data TEXT) WITHOUT ROWID')
+        self._db.commit()
+        self._unsynced = 0
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM ids').fetchone()[0]
+
+    def __iter__(self):
+        return (row[0] for row in self._db.execute('SELECT id FROM ids'))
+
+    def reload(self):
+        pass
+
+    def _row(self, resource_id, values):
+        values = dict(values)
+        timestamp = values.pop('timestamp', time.time())
+        size = values.pop('size', None)
+        data = json.dumps(values) if values else None
+        return str(resource_id), timestamp, size, data
+
+    def add(self, resource_id, **values):
+        self._db.execute(
+            'INSERT OR IGNORE INTO ids VALUES (?, ?, ?, ?)',
+            self._row(resource_id, values))
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def add_many(self, resource_ids):
+        self._db.executemany(
+            'INSERT OR IGNORE INTO ids VALUES (?, ?, ?, ?)',
+            (self._row(resource_id, {}) for resource_id in resource_ids))
+        self.sync()
+
+    def sync(self):
+        self._db.commit()
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._db.close()
+
+    def exists(self, resource_id):
+        return self._db.execute(
+            'SELECT 1 FROM ids WHERE id = ?', (str(resource_id),)
+        ).fetchone() is not None
+
+    def exists_many(self, resource_ids):
+        str_ids = [str(resource_id) for resource_id in resource_ids]
+        found = set()
+        for start in range(0, len(str_ids), SQLITE_CHUNK):
+            chunk = str_ids[start:start + SQLITE_CHUNK]
+            found.update(row[0] for row in self._db.execute(
+                'SELECT id FROM ids WHERE id IN ({})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        return [str_id in found for str_id in str_ids]
+
+    def get(self, resource_id):
+        row = self._db.execute(
+            'SELECT timestamp, size, data FROM ids WHERE id = ?',
+            (str(resource_id),)).fetchone()
+        if row is None:
+            return None
+        values = json.loads(row[2]) if row[2] else {}
+        values.update(timestamp=row[0], size=row[1])
+        return values
+
+
+BACKENDS = {
+    'text': TextBackend,
+    'dbm': DbmBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def backend_location(db_path):
+    """(backend name, path) of a DumbDB path or URL."""
+    scheme, separator, path = str(db_path).partition('://')
+    if separator:
+        if scheme not in BACKENDS:
+            raise ValueError('Unknown DumbDB backend "{}"; expected one of '
+                             '{}'.format(scheme, sorted(BACKENDS)))
+        if path.startswith('/'):
+            path = path[1:]
+        return scheme, path
+
+    suffix = os.path.splitext(db_path)[1].lower()
+    return SUFFIXES.get(suffix, 'text'), str(db_path)
+
+
+class DumbDB(object):
+    """
+    A persistent set of IDs with add/exists, stored in the backend chosen by
+    `db_path` (see backend_location). `options` are passed to the backend:
+    sync_every and fsync for all of them, compact for text files.
+    """
+    def __init__(self, db_path, **options):
+        self.backend_name, self.db_path = backend_location(db_path)
+        self.backend = BACKENDS[self.backend_name](self.db_path, **options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.backend)
+
+    def __iter__(self):
+        return iter(self.backend)
+
+    def __contains__(self, resource_id):
+        return self.backend.exists(resource_id)
+
+    def add(self, resource_id, **values):
+        """`values`, such as timestamp and size, are kept by SQLite and dbm."""
+        self.backend.add(resource_id, **values)
+
+    def add_many(self, resource_ids):
+        """Adds all `resource_ids` at once."""
+        self.backend.add_many(resource_ids)
+
+    def exists(self, resource_id):
+        return self.backend.exists(resource_id)
+
+    def exists_many(self, resource_ids):
+        """Whether each of `resource_ids` exists, in the same order."""
+        return self.backend.exists_many(resource_ids)
+
+    def get(self, resource_id):
+        """The values stored with `resource_id`, or None if it is missing."""
+        return self.backend.get(resource_id)
+
+    def reload(self):
+        self.backend.reload()
+
+    def sync(self):
+        self.backend.sync()
+
+    def close(self):
+        self.backend.close()
+
+
+def migrate(source, destination, chunk_size=10000):
+    """
+    Copies every ID of DumbDB `source` to DumbDB `destination`. The source
+    is only read; a text file is not compacted.
+    """
+    count = 0
+    with DumbDB(source, compact=False) as source_db, \
+            DumbDB(destination) as destination_db:
+        chunk = []
+        for resource_id in source_db:
+            chunk.append(resource_id)
+            if len(chunk) >= chunk_size:
+                destination_db.add_many(chunk)
+                count += len(chunk)
+                chunk = []
+        destination_db.add_many(chunk)
+        count += len(chunk)
+
+    return count
+
+
+if __name__ == "__main__":
+    from docopt import docopt
+
+    options = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO)
+    log.info('Copied {} IDs from {} to {}'.format(
+        migrate(options['<source>'], options['<destination>']),
+        options['<source>'], options['<destination>']))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Writes local temperature history to InfluxDB.
+
+Usage: influx-backfill.py [-i <file>] [-m <file>] [-n <tag>] [-c <file>]
+                          [-b <size>] [-j <n>] [-vv] <history>...
+
+Options:
+    -i <file>      InfluxDB configuration file [default: influxdb-config.yaml].
+    -m <file>      Read sensor metadata from yaml file [default: sensors.yaml].
+    -n <tag>       Metadata attribute the history names sensors by
+                   [default: location].
+    -c <file>      Checkpoint file recording how far each history has been
+                   written [default: backfill-checkpoint.json].
+    -b <size>      Readings per write request [default: 5000].
+    -j <n>         Write requests in flight at the same time [default: 4].
+    -v, --verbose  Verbose output.
+    -h, --help     Print help.
+
+<history> is a temperature.csv file written by ds18b20.py or a CSV sink, or
+a tsstore.py directory. Readings keep the time they were taken. A sensor is
+written with the tags of the sensors.yaml entry whose -n attribute matches
+its name; sensors without one are written with their name as 'sensor_id'.
+Histories hold degrees Celsius (see sinks.py); readings are converted to the
+'scale' of their sensor, as the collector writes them.
+
+Histories are streamed in chunks of -b readings, so memory use does not
+depend on their size. After each chunk is written, and all chunks before it,
+its position is saved to the checkpoint file; running the same command again
+resumes from there. A history that was replaced, e.g. a rotated
+temperature.csv, or that is shorter than its checkpoint is written from the
+start. A chunk that still fails after retries stops the backfill.
+"""
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+import yaml
+
+from docopt import docopt
+
+from influxsink import influxdb_sink, write_measurement
+from lineprotocol import SensorEncoder
+from sinks import parse_csv_line, read_influxdb_config
+from w1sensors import CONVERSIONS, SETTINGS
+
+log = logging.getLogger(__name__)
+
+# attempts per chunk and seconds before the first retry, doubled each time
+WRITE_ATTEMPTS = 5
+RETRY_DELAY = 2
+# sections of the InfluxDB configuration that are not connection settings
+COLLECTOR_SECTIONS = ('batch', 'queue', 'spool')
+
+
+def set_logging(verbosity):
+    if verbosity == 0:
+        logging.basicConfig(level=logging.WARNING)
+    elif verbosity == 1:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.DEBUG)
+
+
+def sensor_encoders(filename, name_tag):
+    """{name: SensorEncoder} for the sensors in a metadata file."""
+    try:
+        with open(filename, 'r') as fh:
+            sensors = yaml.safe_load(fh) or {}
+    except IOError:
+        log.warning('Could not read sensor metadata from {}; '
+                    'ignoring.'.format(filename))
+        return {}
+
+    encoders = {}
+    for sensor_id, metadata in sensors.items():
+        if not isinstance(metadata, dict):
+            continue
+        tags = {name: value for name, value in metadata.items()
+                if name not in SETTINGS + ('sensor_id', 'temperature')}
+        name = str(metadata.get(name_tag, sensor_id))
+        encoders[name] = SensorEncoder(str(sensor_id), tags)
+
+    return encoders
+
+
+class Encoders(object):
+    """Looks up encoders by name, creating them for unknown sensors."""
+    def __init__(self, encoders):
+        self.encoders = encoders
+
+    def line(self, name, timestamp, celsius):
+        encoder = self.encoders.get(name)
+        if encoder is None:
+            log.warning('No metadata for sensor "{}"; writing it without '
+                        'tags.'.format(name))
+            encoder = self.encoders[name] = SensorEncoder(name, {})
+        value = CONVERSIONS[encoder.scale_index](round(celsius * 1000))
+        return encoder.encode(value, timestamp)
+
+
+def csv_chunks(path, position, size):
+    """(end position, [(name, timestamp, value)]) chunks from a byte offset."""
+    with open(path, 'rb') as fh:
+        fh.seek(position)
+        rows = []
+        for line in iter(fh.readline, b''):
+            row = parse_csv_line(line.decode('utf-8', 'replace'))
+            if row is None:
+                if line.strip():
+                    log.warning('Skipped malformed line in {}: {!r}'.format(
+                        path, line))
+                continue
+            rows.append(row)
+            if len(rows) >= size:
+                yield fh.tell(), rows
+                rows = []
+        if rows:
+            yield fh.tell(), rows
+
+
+def tsstore_chunks(path, position, size):
+    """(end position, rows) chunks after skipping `position` records."""
+    from tsstore import TimeSeriesStore
+
+    store = TimeSeriesStore(path)
+    names = store.names()
+    skip = position
+    for _, segment in store.segments():
+        records = store.read_segment(segment)
+        if skip >= len(records):
+            skip -= len(records)
+            continue
+        for start in range(skip, len(records), size):
+            chunk = records[start:start + size]
+            position += len(chunk)
+            yield position, [(names[sensor], timestamp, value / 1000)
+                             for timestamp, sensor, value in chunk.tolist()]
+        skip = 0
+
+
+def history_chunks(path, position, size):
+    if os.path.isdir(path):
+        return tsstore_chunks(path, position, size)
+    return csv_chunks(path, position, size)
+
+
+class Checkpoint(object):
+    """
+    Positions of each history written so far, saved as JSON along with the
+    device and inode of the history, so a rotated file starts over.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, 'r') as fh:
+                self.positions = json.load(fh)
+        except FileNotFoundError:
+            self.positions = {}
+
+    @staticmethod
+    def identity(path):
+        stat_result = os.stat(path)
+        return [stat_result.st_dev, stat_result.st_ino]
+
+    def get(self, path):
+        entry = self.positions.get(os.path.abspath(path))
+        if entry is None:
+            return 0
+        position = entry['position']
+        if entry['identity'] != self.identity(path):
+            log.warning('{} was replaced since it was checkpointed, e.g. '
+                        'rotated; starting from the beginning'.format(path))
+            return 0
+        if os.path.isfile(path) and os.path.getsize(path) < position:
+            log.warning('{} is shorter than its checkpoint ({} bytes); '
+                        'starting from the beginning'.format(path, position))
+            return 0
+        return position
+
+    def save(self, path, position):
+        self.positions[os.path.abspath(path)] = {
+            'position': position, 'identity': self.identity(path)}
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as fh:
+            json.dump(self.positions, fh, indent=2)
+        os.replace(temporary, self.filename)
+
+
+def write_chunk(sink, lines):
+    delay = RETRY_DELAY
+    for attempt in range(WRITE_ATTEMPTS):
+        if write_measurement(lines, sink):
+            return True
+        if attempt + 1 < WRITE_ATTEMPTS:
+            log.info('Retrying in {}s'.format(delay))
+            time.sleep(delay)
+            delay *= 2
+
+    return False
+
+
+def backfill(path, sink, encoders, checkpoint, size, concurrency):
+    """
+    Writes `path` with up to `concurrency` chunks in flight and advances the
+    checkpoint past every chunk that has been written along with all the
+    chunks before it. Returns False if a chunk could not be written.
+    """
+    position = saved = checkpoint.get(path)
+    if position:
+        log.info('Resuming {} from position {}'.format(path, position))
+    # (end position, readings, future) of chunks in the order they were read
+    pending = collections.deque()
+    written = 0
+    failed = False
+    start = time.monotonic()
+
+    def settle(block):
+        nonlocal written, failed, saved
+        while pending and (block or pending[0][2].done()):
+            end, rows, future = pending.popleft()
+            if not future.result():
+                failed = True
+                return
+            written += rows
+            saved = end
+            checkpoint.save(path, end)
+            block = False
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency) as executor:
+        for end, rows in history_chunks(path, position, size):
+            lines = [encoders.line(*row) for row in rows]
+            pending.append(
+                (end, len(rows), executor.submit(write_chunk, sink, lines)))
+            settle(block=len(pending) >= concurrency)
+            if failed:
+                break
+            log.info('{}: {} readings written ({:.0f}/s)'.format(
+                path, written, written / (time.monotonic() - start)))
+        while pending and not failed:
+            settle(block=True)
+
+    if failed:
+        log.error('Stopped backfilling {} at position {}'.format(
+            path, saved))
+        return False
+
+    log.info('{}: {} readings written in {:.1f}s'.format(
+        path, written, time.monotonic() - start))
+    return True
+
+
+if __name__ == "__main__":
+    options = docopt(__doc__)
+    set_logging(options['--verbose'])
+
+    concurrency = int(options['-j'])
+    influx_config = read_influxdb_config(options['-i'])
+    for section in COLLECTOR_SECTIONS:
+        influx_config.pop(section, None)
+    influx_config.setdefault('pool_size', concurrency)
+    sink = influxdb_sink(**influx_config)
+    sink.ensure_database()
+    encoders = Encoders(sensor_encoders(options['-m'], options['-n']))
+    checkpoint = Checkpoint(options['-c'])
+
+    for history in options['<history>']:
+        if not backfill(history, sink, encoders, checkpoint,
+                        int(options['-b']), concurrency):
+            sys.exit(1)
@@ -3,11 +3,38 @@
 """
 Collects temperature data from w1 sensors and store to InfluxDB.
 
-Usage: influx-temperature.py [-m <file>] [-i <file>] [-d] [-vv]
+Usage: influx-temperature.py [-m <file>] [-i <file>] [-o <file>] [-e <engine>]
+                             [-w <path>] [-p <n>] [-r <seconds>] [-s <seconds>]
+                             [-t <seconds>] [--metrics-port <port>]
+                             [--shard <by>] [--hang-timeout <seconds>]
+                             [-d] [-vv]
 
 Options:
     -m <file>      Read sensor metadata from yaml file [default: sensors.yaml].
     -i <file>      InfluxDB configuration file [default: influxdb-config.yaml].
+    -o <file>      Write readings to the sinks configured in this yaml file
+                   instead of only to the InfluxDB configured with -i.
+    -e <engine>    Read sensors with 'w1thermsensor' or directly from 'sysfs'
+                   [default: w1thermsensor].
+    -w <path>      Directory of w1 devices read by the sysfs engine and
+                   watched for changes [default: /sys/bus/w1/devices].
+    -p <n>         Read up to <n> sensors at the same time; 0 reads all sensors
+                   at once [default: 0].
+    -r <seconds>   Seconds between rescans of the 1-Wire bus for new or
+                   removed sensors; changes are also picked up as they happen
+                   when inotify_simple is installed [default: 60].
+    -s <seconds>   Sampling interval of sensors without an 'interval'
+                   attribute [default: 1].
+    -t <seconds>   Write the collector's own 'collector_stats' measurement
+                   every <seconds>; 0 disables it [default: 60].
+    --metrics-port <port>
+                   Also serve the collector's own metrics in the Prometheus
+                   text format on http://localhost:<port>/metrics.
+    --shard <by>   Collect in one worker process per 1-Wire bus master
+                   ('bus') or per group of sensors (the number of groups).
+    --hang-timeout <seconds>
+                   Restart a worker that makes no progress for this long
+                   [default: 30].
     -v, --verbose  Verbose output.
     -d, --daemon   Run script in the background.
     -h, --help     Print help.
@@ -20,6 +47,61 @@ If a 'scale' attribute is provided with a value of either 'c(elsius)',
 'f(ahrenheit)' or 'k(elvin)', the temperature reading for the sensor is stored
 in the requested scale.
 
+Each sensor is sampled once and every reading is handed to all configured
+sinks: InfluxDB, CSV files, Graphite or stdout (see sinks.yaml). Every sink
+has its own queue and writer thread, so a slow sink never holds up the others.
+
+Readings are written to InfluxDB over HTTP with a keep-alive session and
+gzip-compressed bodies, or over UDP when 'use_udp' is set in the InfluxDB
+configuration. The database is only created if it does not exist yet.
+
+With --shard, a supervisor process starts one worker per shard. Workers sample
+their own sensors and hand readings to the supervisor's sinks; a worker that
+exits or hangs is restarted without affecting the others. Each worker has a
+queue of its own to the supervisor, sized by the 'queue' section of the
+InfluxDB configuration, and the supervisor writes its own collector_stats,
+such as write times, alongside the workers'.
+Sharding by bus master requires the sysfs engine.
+
+An 'interval' attribute sets how often, in seconds, the sensor is sampled; it
+is not stored as a tag. Samples are scheduled against fixed deadlines so the
+period does not drift, and a warning is logged when a read overruns it.
+
+To write fewer points for slow-moving sensors:
+  window: <seconds>    write one point per window with the mean as 'value'
+                       plus 'min', 'max' and 'count' fields
+  deadband: <degrees>  skip points that differ from the last written one by
+                       less than this...
+  heartbeat: <seconds> ...unless this long has passed since it [default: 300]
+These attributes are not stored as tags either.
+
+Readings are stored with the time they were taken and written to InfluxDB in
+batches. The batch limits are read from the 'batch' section of the InfluxDB
+configuration file:
+---
+batch:
+  size: 100    # write once this many readings are buffered
+  max_age: 10  # write once the oldest buffered reading is this old (seconds)
+
+Readings are handed to the InfluxDB writer thread through a bounded queue, so
+a slow InfluxDB never delays sampling. What happens when the queue is full is
+set in the 'queue' section, unless the sink has its own; 'overflow' is one of
+drop_oldest, drop_newest or block:
+---
+queue:
+  size: 10000
+  overflow: drop_oldest
+
+Batches that cannot be written are kept in an on-disk spool and replayed once
+InfluxDB is reachable again when a 'spool' section is present:
+---
+spool:
+  directory: spool           # where segment files are kept
+  segment_size: 1048576      # bytes per segment file
+  max_size: 67108864         # oldest records are dropped beyond this size
+  replay_batch: 5000         # records per request when replaying
+  replay_interval: 30        # seconds between attempts while unreachable
+
 Sensor metadata file format:
 ---
 sensor_id:
@@ -33,35 +115,29 @@ e.g.:
 021451a1c7ff
   location: 'living room'
   scale: k
+00000a1cc4f6:
+  location: 'rack'
+  interval: 10
+  window: 60
+  deadband: 0.2
 
 """
 import copy
 import logging
-import os
-import pprint
 import sys
-import time
 import yaml
 
 from docopt import docopt
-from influxdb import InfluxDBClient
-
-log = logging.getLogger(__name__)
 
+from collector import (
+    collect, make_shards, sensor_reader, shard_worker, start_stats)
+from sinks import (
+    FanOut, InfluxDBOutput, make_outputs, read_influxdb_config,
+    read_sinks_config)
+from stats import MetricsServer, Stats
+from supervisor import Supervisor
 
-def initialise_w1thermsensor():
-    os.environ['W1THERMSENSOR_NO_KERNEL_MODULE'] = '1'
-    from w1thermsensor.errors import KernelModuleLoadError
-    del os.environ['W1THERMSENSOR_NO_KERNEL_MODULE']
-
-    try:
-        import w1thermsensor
-        w1thermsensor.core.load_kernel_modules()
-        return w1thermsensor.W1ThermSensor()
-    except KernelModuleLoadError:
-        log.error('Module w1thermsensor could not load required kernel '
-                  'modules. Run as root or load them yourself.')
-        return None
+log = logging.getLogger(__name__)
 
 
 def validate_metadata_is_reserved(sensor_id, meta_name):
@@ -100,7 +176,7 @@ def read_sensor_metadata(filename):
     sensor_metadata = {}
     try:
         with open(filename, 'r') as fh:
-            sensor_metadata = yaml.load(fh)
+            sensor_metadata = yaml.safe_load(fh)
     except IOError:
         log.warning('Could not read sensor metadata from {}; '
                     'ignoring.'.format(filename))
@@ -118,90 +194,14 @@ def set_logging(verbosity):
         logging.basicConfig(level=logging.DEBUG)
 
 
-def influxdb_client(config_filename):
-    kwargs = {}
-    try:
-        with open(config_filename, 'r') as fh:
-            kwargs = yaml.load(fh)
-    except IOError:
-        log.info('Could not read InfluxDB configuration from {}'.format(
-            config_filename))
-
-    log.debug('Connecting to InfluxDB with: "{}"'.format(
-        pprint.pformat(kwargs)))
-    client = InfluxDBClient(**kwargs)
-    database = kwargs.get('database', 'default')
-    log.debug('Creating and switching to database "{}"'.format(database))
-    client.create_database(database)
-    client.switch_database(database)
-
-    return client
-
-
-def temperature_in_scale(temperatures_cfk, scale):
-    scale = scale or 'c'
-    if scale.lower().startswith('c'):
-        temperature = temperatures_cfk[0]
-    elif scale.lower().startswith('f'):
-        temperature = temperatures_cfk[1]
-    elif scale.lower().startswith('k'):
-        temperature = temperatures_cfk[2]
+def make_sinks(options, stats):
+    if options['-o']:
+        outputs = make_outputs(read_sinks_config(options['-o']), stats)
     else:
-        log.info('Unknown temperature scale "{scale}"; '
-                 'using Celsius.'.format(**locals()))
-        temperature = temperatures_cfk[0]
-
-    return temperature
-
+        output = InfluxDBOutput(read_influxdb_config(options['-i']), stats)
+        outputs = {'influxdb': (output, output.queue_config)}
 
-def format_measurement_tags(metadata):
-    tags = ''
-    for meta_name, meta_value in metadata.items():
-        tags += ',{meta_name}={meta_value}'.format(**locals())
-
-    return tags
-
-
-def format_measurement(sensor_id, metadata, temp_all_units):
-    value = temperature_in_scale(temp_all_units, metadata.get('scale'))
-    tags = format_measurement_tags(metadata)
-    template = 'temperature,sensor_id={sensor_id}{tags} value={value}'
-    measurement = template.format(**locals())
-
-    log.info('Formatted record: "{}"'.format(measurement))
-
-    return measurement
-
-
-def write_measurement(line, influx):
-    result = influx.write_points(line, time_precision='s', protocol='line')
-    if result:
-        log.debug('Datum written to InfluxDB: "{}"'.format(line))
-    else:
-        log.error('Failed to write to InfluxDB: "{}"'.format(line))
-
-def is_valid_reading(metadata, temp_all_units):
-    value = temperature_in_scale(temp_all_units, metadata.get('scale'))
-    if value < -10 or value > 60:
-        return False
-    return True
-
-def temperature_collection_loop(w1client, all_metadata, influx):
-    while True:
-        for sensor in w1client.get_available_sensors():
-            temp_all_units = sensor.get_temperatures([
-                w1client.DEGREES_C,
-                w1client.DEGREES_F,
-                w1client.KELVIN])
-            sensor_meta = all_metadata.get(sensor.id, {})
-
-            line = format_measurement(sensor.id, sensor_meta, temp_all_units),
-            if is_valid_reading(sensor_meta, temp_all_units):
-                write_measurement(line, influx)
-            else:
-                log.error('Ignored bad temperature: "{}"'.format(line))
-
-        time.sleep(1)
+    return FanOut(outputs)
 
 
 if __name__ == "__main__":
@@ -211,13 +211,56 @@ if __name__ == "__main__":
     if options['--daemon']:
         log.warning('-d is not implemented; ignoring.')
 
-    w1_client = initialise_w1thermsensor()
-    if w1_client is None:
-        sys.exit(1)
+    shards = None
+    reader = None
+    if options['--shard']:
+        shards = make_shards(
+            options['--shard'], options['-e'], options['-w'])
+        if not shards:
+            sys.exit(1)
+    else:
+        reader = sensor_reader(options['-e'], options['-w'])
+        if reader is None:
+            sys.exit(1)
     metadata = read_sensor_metadata(options['-m'])
-    idb_client = influxdb_client(options['-i'])
+    settings = dict(
+        parallel=int(options['-p']),
+        refresh_interval=float(options['-r']),
+        default_interval=float(options['-s']),
+        stats_interval=float(options['-t']))
+    collector_stats = Stats()
+    fanout = make_sinks(options, collector_stats)
+    fanout.start()
+    stats_reporter = None
+    if shards:
+        # the sinks record their writes in this process's stats
+        stats_reporter = start_stats(
+            collector_stats, settings['stats_interval'], fanout)
+    metrics_server = None
+    if options['--metrics-port']:
+        metrics_server = MetricsServer(
+            collector_stats, int(options['--metrics-port']))
+        metrics_server.start()
+
+    supervisor = None
     try:
-        log.debug('Initialisation complete; entering collection loop.')
-        temperature_collection_loop(w1_client, metadata, idb_client)
+        if shards:
+            supervisor = Supervisor(
+                shards, shard_worker, fanout,
+                args=(options['-e'], metadata, settings),
+                queue_config=read_influxdb_config(options['-i']).get('queue'),
+                hang_timeout=float(options['--hang-timeout']))
+            supervisor.run()
+        else:
+            collect(reader, options['-w'], metadata, fanout,
+                    collector_stats, **settings)
     except KeyboardInterrupt:
         log.info('Keyboard interrupt received; exiting.')
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
+        if stats_reporter is not None:
+            stats_reporter.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        fanout.stop()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered writes of line-protocol records to InfluxDB.
+
+Records are expected to carry their own timestamp (see
+`lineprotocol.timestamp_now`), so
+the time a batch is flushed has no effect on the time stored for a reading.
+That also allows batches that could not be written to be kept in a spool
+and replayed later.
+
+Records are sent through a sink, an object whose `write(lines)` returns True
+once InfluxDB has the records (or will never accept them) and False when
+they should be tried again later:
+
+* HttpSink keeps a pooled keep-alive session and gzips request bodies;
+* UdpSink sends datagrams to an InfluxDB UDP listener, fire and forget.
+"""
+import gzip
+import json
+import logging
+import socket
+import time
+
+import requests
+
+from lineprotocol import TIME_PRECISION
+
+log = logging.getLogger(__name__)
+
+
+def write_measurement(lines, sink):
+    result = sink.write(lines)
+    if result:
+        log.debug('{} records written to InfluxDB'.format(len(lines)))
+    else:
+        log.error('Failed to write {} records to InfluxDB'.format(len(lines)))
+
+    return result
+
+
+class HttpSink(object):
+    """
+    Writes through InfluxDB's HTTP /write endpoint. Accepts the connection
+    keyword arguments of influxdb.InfluxDBClient plus `gzip` and `pool_size`;
+    `retries` is the number of retries after a failed connection.
+    """
+    def __init__(self, host='localhost', port=8086, username='root',
+                 password='root', database='default', ssl=False,
+                 verify_ssl=False, timeout=None, retries=3, proxies=None,
+                 gzip=True, pool_size=2, **kwargs):
+        for name in kwargs:
+            log.warning('Ignoring unsupported InfluxDB option "{}"'.format(
+                name))
+        scheme = 'https' if ssl else 'http'
+        self.url = '{scheme}://{host}:{port}'.format(**locals())
+        self.database = database
+        self.timeout = timeout
+        self.gzip = gzip
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.verify = verify_ssl
+        self.session.proxies = proxies or {}
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount(scheme + '://', adapter)
+
+    def __repr__(self):
+        return 'HttpSink({}, database={})'.format(self.url, self.database)
+
+    def _query(self, query, method='GET'):
+        response = self.session.request(
+            method, self.url + '/query', params={'q': query},
+            timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def ensure_database(self):
+        """Creates the database unless it already exists."""
+        try:
+            result = self._query('SHOW DATABASES')
+            series = result['results'][0].get('series', [{}])[0]
+            existing = [row[0] for row in series.get('values', [])]
+            if self.database in existing:
+                return True
+            log.info('Creating database "{}"'.format(self.database))
+            self._query('CREATE DATABASE {}'.format(
+                json.dumps(self.database)), method='POST')
+            return True
+        except (requests.RequestException, ValueError, LookupError) as e:
+            log.warning('Could not check database "{}": {}'.format(
+                self.database, e))
+            return False
+
+    def write(self, lines):
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+        headers = {'Content-Type': 'application/octet-stream'}
+        if self.gzip:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+
+        try:
+            response = self.session.post(
+                self.url + '/write', data=body, headers=headers,
+                params={'db': self.database, 'precision': TIME_PRECISION},
+                timeout=self.timeout)
+        except requests.RequestException as e:
+            log.error('Failed to write to InfluxDB: {}'.format(e))
+            return False
+
+        if response.status_code == 204:
+            return True
+        if response.status_code == 400:
+            # malformed records will never be accepted; don't spool them
+            log.error('InfluxDB rejected {} records: {}'.format(
+                len(lines), response.text))
+            return True
+
+        log.error('InfluxDB answered {}: {}'.format(
+            response.status_code, response.text))
+        return False
+
+
+class UdpSink(object):
+    """
+    Writes to an InfluxDB UDP listener, packing records into datagrams of at
+    most `max_datagram` bytes. The listener's database and precision are set
+    in the server's [[udp]] configuration, which must use precision "ms".
+    UDP gives no delivery feedback, so a write only fails when the datagram
+    cannot be sent.
+    """
+    def __init__(self, host='localhost', udp_port=4444, max_datagram=1400,
+                 **kwargs):
+        self.address = (host, udp_port)
+        self.max_datagram = max_datagram
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __repr__(self):
+        return 'UdpSink({}:{})'.format(*self.address)
+
+    def ensure_database(self):
+        return True
+
+    def datagrams(self, lines):
+        datagram = b''
+        for line in lines:
+            record = line.encode('utf-8') + b'\n'
+            if datagram and len(datagram) + len(record) > self.max_datagram:
+                yield datagram
+                datagram = b''
+            datagram += record
+        if datagram:
+            yield datagram
+
+    def write(self, lines):
+        try:
+            for datagram in self.datagrams(lines):
+                self.socket.sendto(datagram, self.address)
+        except OSError as e:
+            log.error('Failed to send to InfluxDB over UDP: {}'.format(e))
+            return False
+
+        return True
+
+
+def influxdb_sink(use_udp=False, **kwargs):
+    if use_udp:
+        return UdpSink(**kwargs)
+    return HttpSink(**kwargs)
+
+
+class BatchWriter(object):
+    """
+    Collects line-protocol records and writes them in a single request once
+    `size` records are buffered or the oldest one is `max_age` seconds old.
+
+    With a `spool`, batches that fail to write are stored on disk. While the
+    spool holds a backlog new batches are appended to it directly instead of
+    waiting on an unreachable server; the replayer sends them once it is back.
+    Each batch appended behind a backlog wakes `replayer`, if given, so the
+    backlog starts draining with the first batch after the server returns
+    rather than after the replay interval.
+
+    Write latency, batch sizes and failures are recorded in `stats`, a
+    stats.Stats, when given.
+    """
+    def __init__(self, sink, size=100, max_age=10, spool=None, stats=None,
+                 replayer=None):
+        self.sink = sink
+        self.size = size
+        self.max_age = max_age
+        self.spool = spool
+        self.replayer = replayer
+        self.stats = stats
+        self._lines = []
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, line):
+        if not self._lines:
+            self._oldest = time.monotonic()
+        self._lines.append(line)
+        self.flush_if_due()
+
+    def is_due(self):
+        if not self._lines:
+            return False
+        if len(self._lines) >= self.size:
+            return True
+        return (time.monotonic() - self._oldest) >= self.max_age
+
+    def flush_if_due(self):
+        if self.is_due():
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self._lines:
+            return True
+
+        lines, self._lines = self._lines, []
+        if self.spool is None:
+            return self._write(lines)
+
+        if len(self.spool):
+            self.spool.append(lines)
+            if self.replayer is not None:
+                self.replayer.wake()
+        elif not self._write(lines):
+            self.spool.append(lines)
+        return True
+
+    def _write(self, lines):
+        start = time.perf_counter()
+        result = write_measurement(lines, self.sink)
+        if self.stats is not None:
+            self.stats.observe('write_seconds', time.perf_counter() - start)
+            self.stats.observe('batch_size', len(lines))
+            if not result:
+                self.stats.count('write_errors')
+        return result
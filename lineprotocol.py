@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+InfluxDB line-protocol encoding for temperature readings.
+
+https://docs.influxdata.com/influxdb/v1.7/write_protocols/line_protocol_reference/
+"""
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+MEASUREMENT = 'temperature'
+TIME_PRECISION = 'ms'
+# position of each scale in the (celsius, fahrenheit, kelvin) reading tuple
+SCALES = {'c': 0, 'f': 1, 'k': 2}
+
+
+def timestamp_now():
+    """Current wall-clock time in TIME_PRECISION units."""
+    return int(time.time() * 1000)
+
+
+def escape_tag(text):
+    """Escapes a tag key or value; commas, equals signs and spaces."""
+    return (str(text).replace('\\', '\\\\').replace(',', '\\,')
+            .replace('=', '\\=').replace(' ', '\\ '))
+
+
+def escape_measurement(text):
+    return str(text).replace(',', '\\,').replace(' ', '\\ ')
+
+
+def scale_index(scale):
+    scale = str(scale or 'c')
+    index = SCALES.get(scale[:1].lower())
+    if index is None:
+        log.info('Unknown temperature scale "{scale}"; '
+                 'using Celsius.'.format(**locals()))
+        index = SCALES['c']
+
+    return index
+
+
+def format_tags(tags):
+    """Sorted, escaped ',key=value' pairs; InfluxDB prefers sorted tags."""
+    return ''.join(
+        ',{}={}'.format(escape_tag(name), escape_tag(value))
+        for name, value in sorted(tags.items()))
+
+
+class SensorEncoder(object):
+    """
+    Line-protocol encoder for a single sensor. The measurement, tag set and
+    scale are resolved once so encoding a reading is one string format.
+    """
+    __slots__ = ('prefix', 'scale_index')
+
+    def __init__(self, sensor_id, metadata, measurement=MEASUREMENT):
+        tags = dict(metadata)
+        tags['sensor_id'] = sensor_id
+        self.prefix = '{}{} value='.format(
+            escape_measurement(measurement), format_tags(tags))
+        self.scale_index = scale_index(metadata.get('scale'))
+
+    def value(self, temp_all_units):
+        return temp_all_units[self.scale_index]
+
+    def encode(self, value, timestamp):
+        return '%s%r %d' % (self.prefix, value, timestamp)
+
+    def encode_summary(self, mean, minimum, maximum, count, timestamp):
+        return '%s%r,min=%r,max=%r,count=%di %d' % (
+            self.prefix, mean, minimum, maximum, count, timestamp)
@@ -0,0 +1,246 @@
+"""
+Finding media files in a download tree that are ready to be moved.
+
+MediaScanner walks the tree incrementally; MediaWatcher reports files as they
+arrive through inotify.
+
+The scanner lists every directory with os.scandir and stats every candidate
+file once. A directory whose mtime is unchanged since the last scan, and
+which had no files still downloading, too recent or empty, has no new files,
+so it is not listed again; only its subdirectories, remembered from the last
+scan, are visited. The state is kept in a JSON file between runs.
+"""
+import json
+import logging
+import os
+import time
+
+from pathlib import Path
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+log = logging.getLogger(__name__)
+
+ARIA2_SUFFIX = '.aria2'
+SKIP_DIRS = ('.AppleDouble',)
+# directories modified this recently are listed again on the next scan, as
+# entries created within the mtime granularity could otherwise be missed
+MTIME_SLACK = 2
+
+
+def is_ready(stat_result, min_age, now):
+    """Whether a media file is complete and old enough to move."""
+    return stat_result.st_size > 0 and now - stat_result.st_mtime >= min_age
+
+
+class MediaScanner(object):
+    """
+    Yields media files under a directory that were not yielded by earlier
+    scans. Call `commit` once they have been handled to save the state.
+    """
+    def __init__(self, state_path, suffixes, min_age, skip_dirs=SKIP_DIRS,
+                 clock=time.time):
+        self.state_path = state_path
+        self.suffixes = tuple(suffixes)
+        self.min_age = min_age
+        self.skip_dirs = skip_dirs
+        self.clock = clock
+        self.listed = 0
+        self.pruned = 0
+        self._next_state = None
+        self.state = {}
+        try:
+            with open(state_path, 'r') as fh:
+                self.state = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning('Ignoring unreadable scan state {}: {}'.format(
+                state_path, e))
+
+    def scan(self, root):
+        now = self.clock()
+        state = {}
+        stack = [str(root)]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            previous = self.state.get(path)
+            if previous is not None and previous['mtime'] == mtime and \
+                    not previous['pending']:
+                self.pruned += 1
+                state[path] = previous
+                stack.extend(previous['dirs'])
+                continue
+
+            self.listed += 1
+            dirs = []
+            pending = now - mtime / 1e9 < MTIME_SLACK
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError as e:
+                log.warning('Could not list {}: {}'.format(path, e))
+                continue
+            names = {entry.name for entry in entries}
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in self.skip_dirs:
+                        dirs.append(entry.path)
+                    continue
+                if not entry.name.endswith(self.suffixes):
+                    continue
+                # downloads in progress (f.ext -> f.ext.aria2)
+                if entry.name + ARIA2_SUFFIX in names:
+                    pending = True
+                    continue
+                if not is_ready(entry.stat(), self.min_age, now):
+                    pending = True
+                    continue
+
+                yield Path(entry.path)
+
+            state[path] = {'mtime': mtime, 'dirs': dirs, 'pending': pending}
+            stack.extend(dirs)
+
+        self._next_state = state
+
+    def commit(self):
+        """Saves the state of the last complete scan."""
+        if self._next_state is None:
+            return
+        self.state, self._next_state = self._next_state, None
+        temporary = self.state_path + '.tmp'
+        with open(temporary, 'w') as fh:
+            json.dump(self.state, fh)
+        os.replace(temporary, self.state_path)
+
+    def report(self):
+        return 'Scan: {} directories listed, {} unchanged'.format(
+            self.listed, self.pruned)
+
+
+class MediaWatcher(object):
+    """
+    Reports media files under `root` once nothing has happened to them for
+    `quiet_period` seconds after they were written (close-write) or moved in,
+    using inotify watches on every directory. A download is only reported
+    after its aria2 sidecar has been removed. Requires inotify_simple.
+    """
+    def __init__(self, root, suffixes, quiet_period, skip_dirs=SKIP_DIRS,
+                 clock=time.monotonic):
+        if inotify_simple is None:
+            raise RuntimeError('Watching requires inotify_simple; '
+                               '`pip install inotify_simple`.')
+        self.root = str(root)
+        self.suffixes = tuple(suffixes)
+        self.quiet_period = quiet_period
+        self.skip_dirs = skip_dirs
+        self.clock = clock
+        flags = inotify_simple.flags
+        self._flags = flags
+        self._mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                      flags.CREATE | flags.DELETE)
+        self._inotify = inotify_simple.INotify()
+        self._dirs = {}
+        self._deadlines = {}
+        self._add_tree(self.root)
+
+    def _add_tree(self, path, arm=False):
+        """Watches `path` and its subdirectories; `arm` queues their files."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [name for name in dirnames
+                           if name not in self.skip_dirs]
+            try:
+                self._dirs[self._inotify.add_watch(dirpath, self._mask)] = \
+                    dirpath
+            except OSError as e:
+                log.warning('Could not watch {}: {}'.format(dirpath, e))
+            if arm:
+                for name in filenames:
+                    self._touch(os.path.join(dirpath, name))
+
+    def _forget_tree(self, path):
+        """Stops watching `path` and its subdirectories, e.g. moved away."""
+        prefix = path + os.sep
+        for wd, dirpath in list(self._dirs.items()):
+            if dirpath == path or dirpath.startswith(prefix):
+                del self._dirs[wd]
+                try:
+                    self._inotify.rm_watch(wd)
+                except OSError:
+                    pass  # removed along with its directory
+        for file_path in list(self._deadlines):
+            if file_path.startswith(prefix):
+                del self._deadlines[file_path]
+
+    def _touch(self, path):
+        if path.endswith(self.suffixes):
+            self._deadlines[path] = self.clock() + self.quiet_period
+
+    def _handle(self, event):
+        flags = self._flags
+        if event.mask & flags.Q_OVERFLOW:
+            log.warning('inotify queue overflowed; rechecking all files')
+            self._add_tree(self.root, arm=True)
+            return
+        if event.mask & flags.IGNORED:
+            self._dirs.pop(event.wd, None)
+            return
+        directory = self._dirs.get(event.wd)
+        if directory is None:
+            return
+
+        path = os.path.join(directory, event.name)
+        removed = event.mask & (flags.DELETE | flags.MOVED_FROM)
+        if event.mask & flags.ISDIR:
+            if removed:
+                self._forget_tree(path)
+            elif event.name not in self.skip_dirs:
+                self._add_tree(path, arm=True)
+        elif event.name.endswith(ARIA2_SUFFIX):
+            if removed:
+                self._touch(path[:-len(ARIA2_SUFFIX)])
+        elif removed:
+            self._deadlines.pop(path, None)
+        elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+            self._touch(path)
+
+    def _due(self):
+        now = self.clock()
+        ready = []
+        for path, deadline in list(self._deadlines.items()):
+            if deadline > now:
+                continue
+            del self._deadlines[path]
+            # the sidecar's removal queues the file again
+            if os.path.exists(path + ARIA2_SUFFIX):
+                continue
+            try:
+                if os.stat(path).st_size > 0:
+                    ready.append(Path(path))
+            except FileNotFoundError:
+                pass
+
+        return ready
+
+    def batches(self):
+        """Yields lists of files ready to move; sleeps until there are any."""
+        while True:
+            timeout = None
+            if self._deadlines:
+                delay = min(self._deadlines.values()) - self.clock()
+                timeout = max(0, int(delay * 1000) + 1)
+            for event in self._inotify.read(timeout=timeout):
+                self._handle(event)
+
+            ready = self._due()
+            if ready:
+                yield ready
@@ -1,14 +1,45 @@
+"""
+Moves finished downloads into the TV and movie libraries.
+
+Usage: movemedia.py [--watch] [-j <n>] [-w <n>] [-r <rate>]
+
+Options:
+    --watch     Keep running and move files as they arrive, using inotify
+                (requires inotify_simple).
+    -j <n>      Move up to <n> files at the same time [default: 2].
+    -w <n>      Look up to <n> titles up on OMDB at the same time
+                [default: 8].
+    -r <rate>   Send at most <rate> OMDB requests per second [default: 5].
+    -h, --help  Print help.
+
+File names are parsed once and all OMDB lookups of a batch of new files are
+made concurrently before any file is moved; cached titles need no request.
+
+Files are renamed into place when the library is on the same filesystem and
+otherwise copied (zero-copy where the kernel allows), checked for size and
+only then removed from the download folder.
+
+Without --watch, the download folder is scanned once and the script exits
+with status 1 if nothing was moved. With --watch, it is scanned once and
+then every file that is written or moved in is moved after being left alone
+for MIN_MTIME_TO_MOVE seconds.
+"""
+import collections
+import concurrent.futures
 import os
 import re
-import shutil
-import time
 
 from pathlib import Path
 
 import PTN  # https://github.com/divijbindlish/parse-torrent-name
+import requests
+from docopt import docopt
 from omdbapi.movie_search import GetMovie  # ombdapi==0.5.1
 
 from dumbdb import DumbDB
+from mediascan import MediaScanner, MediaWatcher
+from omdbcache import OmdbCache, RateLimiter
+from transfer import Mover, TransferError, throughput
 
 
 OMDBAPI_KEY = os.environ['OMDBAPI_KEY']
@@ -18,6 +49,9 @@ MOVIE_BASE = Path('/mnt/Multimedia/Movies')
 # FIXME refactor TV_MOVED
 TV_MOVED = {}
 MIN_MTIME_TO_MOVE = 60  # don't move files modified less than second ago
+OMDB_CACHE_PATH = 'movemedia_omdb_cache.json'
+SCAN_STATE_PATH = 'movemedia_scan.json'
+SOURCE_PATH = Path('/home/thiago/putio')
 
 # FIXME Talkshows like Stephen Colbert get funky metadata
 # e.g.: Stephen.Colbert.2019.07.24.Chris.Wallace.PROPER.1080p.WEB.x264-KOMPOST.mkv
@@ -32,52 +66,61 @@ MIN_MTIME_TO_MOVE = 60  # don't move files modified less than second ago
 KNOWN_TV_TITLES = ['stephen colbert']
 
 
-def media_iter(source_path):
-    for file in Path(source_path).glob('**/*'):
-        # skip non-media files
-        if file.suffix not in MEDIA_SUFFIXES:
-            continue
+# a media file with the metadata PTN parsed from its name
+MediaFile = collections.namedtuple('MediaFile', 'path metadata')
 
-        # skip APF stuff
-        if '.AppleDouble' in str(file.absolute()):
-            continue
 
-        # skip downloads in progress (f.ext -> f.ext.aria2)
-        if file.with_suffix(file.suffix + '.aria2').exists():
-            continue
+def parse_media(file):
+    return MediaFile(file, PTN.parse(file.name))
 
-        # skip empty files
-        if file.stat().st_size == 0:
-            continue
 
-        # skip files that were recently modified
-        if (time.time() - file.stat().st_mtime) < MIN_MTIME_TO_MOVE:
-            continue
-
-        yield file
-
-
-def get_movie_title_year(file):
-    metadata = PTN.parse(file.name)
+def get_movie_title_year(metadata):
     if not (metadata['title'] and metadata.get('year')):
         return None, None
 
     return metadata['title'], metadata['year']
 
 
-def is_movie(file):
+class OmdbError(Exception):
+    pass
+
+
+def omdb_year(title):
+    """OMDB's 'Year' of the title, or None if OMDB does not know it."""
+    try:
+        movie = GetMovie(title=title, api_key=OMDBAPI_KEY)
+    except (requests.RequestException, ValueError) as e:
+        # network failures and unreadable replies are retried, never cached
+        raise OmdbError(f'request failed: {e}') from e
+    if movie.values.get('Response') == 'True':
+        return movie.values.get('Year')
+
+    # only cache "not found"; errors such as the request limit are retried
+    error = movie.values.get('Error', '')
+    if 'not found' in error.lower():
+        return None
+    raise OmdbError(error)
+
+
+def is_movie(media, omdb_years):
     """
-    :type file: Path
+    :type media: MediaFile
+    :param omdb_years: OMDB results by (title, year), see Classifier
     """
-    title, year = get_movie_title_year(file)
+    title, year = get_movie_title_year(media.metadata)
     if not (title and year):
         print('    x Not a movie: missing title and/or year')
         return False
 
-    movie = GetMovie(title=title, api_key=OMDBAPI_KEY)
     try:
-        movie_year = int(movie.get_data('Year')['Year'])
-    except ValueError:
+        result = omdb_years[(title, year)]
+        if isinstance(result, OmdbError):
+            raise result
+        movie_year = int(result)
+    except OmdbError as e:
+        print(f'    x Not a movie; OMDB lookup failed: {e}')
+        return False
+    except (TypeError, ValueError):
         print(f'    x Not a movie; not found on OMDB: {title}')
         return False
 
@@ -98,7 +141,7 @@ def _is_tv_episode(mdata):
     return mdata['title'] and mdata.get('season') and mdata.get('episode')
 
 
-def destination_guess(file):
+def destination_guess(media):
     def _is_match(a, b):
         return a['season'] == b['season'] and a['episode'] == b['episode']
 
@@ -109,7 +152,7 @@ def destination_guess(file):
         })
 
 
-    metadata = PTN.parse(file.name)
+    metadata = media.metadata
 
     if not _is_tv_episode(metadata):
         print(f'    x Not TV: missing title, season and/or episode {metadata}')
@@ -135,54 +178,156 @@ def safe_filename(name):
     return "".join([c for c in name if c.isalpha() or c.isdigit() or c in safe_chars]).rstrip()
 
 
-def get_destination(file):
-    destination = destination_guess(file)
+def get_destination(media, omdb_years):
+    destination = destination_guess(media)
 
     if destination is None:
-        if is_movie(file):
-            title, year = get_movie_title_year(file)
+        if is_movie(media, omdb_years):
+            title, year = get_movie_title_year(media.metadata)
             folder = safe_filename(f'{title}.{year}')
             destination = MOVIE_BASE.joinpath(folder)
-            destination.mkdir()
 
     return destination
 
 
-def move_with_create(file_path, target_path):
-    if target_path.joinpath(f.name).exists():
-        print(f'    ERROR. Already exists: {target_path.joinpath(f.name)}')
-        return False
-
-    if not target_path.exists():
-        os.makedirs(str(target_path), mode=0o777)
-
+class Classifier(object):
+    """
+    Parses each file name once and resolves the OMDB lookups of a whole batch
+    of files through `workers` threads, before deciding where files go.
+    OMDB requests (cache misses) are limited to `rate` per second. A failed
+    lookup is kept as its OmdbError, so it only leaves its own title out.
+    """
+    def __init__(self, workers=8, rate=5):
+        self.workers = workers
+        limiter = RateLimiter(rate)
+
+        def fetch(title):
+            limiter.wait()
+            return omdb_year(title)
+
+        self.omdb_cache = OmdbCache(fetch, OMDB_CACHE_PATH)
+
+    def lookup(self, key):
+        # must not raise: one failure would abort the whole batch's map
+        try:
+            return self.omdb_cache.lookup(*key)
+        except OmdbError as e:
+            return e
+
+    def lookup_movies(self, media):
+        """{(title, year): OMDB year, None or OmdbError} of possible movies."""
+        keys = set()
+        for item in media:
+            if _is_tv_episode(item.metadata):
+                continue
+            title, year = get_movie_title_year(item.metadata)
+            if title and year:
+                keys.add((title, year))
+        if not keys:
+            return {}
+
+        keys = list(keys)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.workers, len(keys)),
+                thread_name_prefix='omdb') as executor:
+            return dict(zip(keys, executor.map(self.lookup, keys)))
+
+    def classify(self, files):
+        """Yields (file, destination or None) in the order of `files`."""
+        media = [parse_media(f) for f in files]
+        omdb_years = _LookupOnDemand(self, self.lookup_movies(media))
+        for item in media:
+            print(item.path)
+            yield item.path, get_destination(item, omdb_years)
+
+    def save(self):
+        self.omdb_cache.save()
+        print(self.omdb_cache.report())
+
+
+class _LookupOnDemand(dict):
+    """Looks up titles not resolved in advance, e.g. duplicate episodes."""
+    def __init__(self, classifier, results):
+        super().__init__(results)
+        self.classifier = classifier
+
+    def __missing__(self, key):
+        self[key] = self.classifier.lookup(key)
+        return self[key]
+
+
+def report_move(future):
     try:
-        shutil.move(str(file_path), str(target_path))
-    except (shutil.Error, OSError) as e:
+        transfer = future.result()
+    except (TransferError, OSError) as e:
         print(f'    ERROR. {e}')
         return False
 
+    print(f'    ✓ {transfer.destination}: {throughput(transfer)}')
     return True
 
 
-print('Processing media files')
-processed_files = DumbDB('movemedia_processed.txt')
-something_moved = False
-for f in media_iter('/home/thiago/putio'):
-
-    if processed_files.exists(str(f)):
-        continue
-
-    print(f)
-
-    target_path = get_destination(f)
-    if target_path is not None:
-        print(f'    ↦ Moving to {target_path}', end='', flush=True)
-        move_with_create(f, target_path)
-        print()
-        something_moved = True
-
-    processed_files.add(str(f))
-
-if not something_moved:
-    exit(1)
+def process_media(media_files, processed_files, classifier, mover):
+    """Moves the files not processed before; returns whether any moved."""
+    # episodes are only deduplicated within a batch, as in a single run, so
+    # --watch does not remember every episode for the life of the process
+    TV_MOVED.clear()
+    processed = processed_files.exists_many(str(f) for f in media_files)
+    new_files = [f for f, is_processed in zip(media_files, processed)
+                 if not is_processed]
+    processed_now = []
+    moves = []
+    try:
+        for f, target_path in classifier.classify(new_files):
+            if target_path is not None:
+                print(f'    ↦ Moving to {target_path}')
+                moves.append(mover.submit(f, target_path))
+
+            processed_now.append(str(f))
+    finally:
+        moved = [report_move(future)
+                 for future in concurrent.futures.as_completed(moves)]
+        something_moved = any(moved)
+        processed_files.add_many(processed_now)
+        classifier.save()
+
+    return something_moved
+
+
+def scan_and_process(processed_files, classifier, mover):
+    scanner = MediaScanner(SCAN_STATE_PATH, MEDIA_SUFFIXES, MIN_MTIME_TO_MOVE)
+    media_files = list(scanner.scan(SOURCE_PATH))
+    print(scanner.report())
+    something_moved = process_media(
+        media_files, processed_files, classifier, mover)
+    # only skip unchanged directories once their files have been handled
+    scanner.commit()
+
+    return something_moved
+
+
+def watch(processed_files, classifier, mover):
+    # watch before scanning so nothing arriving meanwhile is missed
+    watcher = MediaWatcher(SOURCE_PATH, MEDIA_SUFFIXES, MIN_MTIME_TO_MOVE)
+    scan_and_process(processed_files, classifier, mover)
+    print(f'Watching {SOURCE_PATH}')
+    for media_files in watcher.batches():
+        process_media(media_files, processed_files, classifier, mover)
+
+
+if __name__ == '__main__':
+    options = docopt(__doc__)
+    print('Processing media files')
+    processed_files = DumbDB('movemedia_processed.txt')
+    classifier = Classifier(int(options['-w']), float(options['-r']))
+    mover = Mover(int(options['-j']))
+    try:
+        if options['--watch']:
+            watch(processed_files, classifier, mover)
+        elif not scan_and_process(processed_files, classifier, mover):
+            exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mover.shutdown()
+        processed_files.close()
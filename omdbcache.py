@@ -0,0 +1,108 @@
+"""
+Persistent cache of OMDB lookups, so titles seen in earlier runs or shared by
+several files are only looked up once.
+
+Entries are keyed by normalised title and year and kept in a JSON file.
+Results expire after `ttl` seconds; titles OMDB does not know are cached as
+well, for the shorter `negative_ttl`. Failed lookups (exceptions) are not
+cached.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DAY = 86400
+
+
+def normalise_title(title):
+    """Lower case words of `title`, without punctuation."""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', str(title).lower()).split())
+
+
+class RateLimiter(object):
+    """Spaces calls to `wait` at least 1/`rate` seconds apart across threads."""
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self.clock()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            self.sleep(start - now)
+
+
+class OmdbCache(object):
+    """
+    Caches `fetch(title)`, which returns what is to be kept for a title or
+    None when OMDB does not know it. Safe to use from several threads.
+    """
+    def __init__(self, fetch, path='omdb_cache.json', ttl=90 * DAY,
+                 negative_ttl=2 * DAY, clock=time.time):
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries = {}
+        try:
+            with open(path, 'r') as fh:
+                self._entries = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning('Ignoring unreadable OMDB cache {}: {}'.format(
+                path, e))
+
+    @staticmethod
+    def key(title, year):
+        return '{}|{}'.format(normalise_title(title), year or '')
+
+    def _fresh(self, entry):
+        ttl = self.ttl if entry['data'] is not None else self.negative_ttl
+        return self.clock() - entry['fetched'] < ttl
+
+    def lookup(self, title, year=None):
+        key = self.key(title, year)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._fresh(entry):
+                self.hits += 1
+                return entry['data']
+            self.misses += 1
+
+        data = self.fetch(title)
+        with self._lock:
+            self._entries[key] = {'data': data, 'fetched': self.clock()}
+            self._dirty = True
+        return data
+
+    def save(self):
+        """Writes the cache file, dropping expired entries."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = {key: entry for key, entry in self._entries.items()
+                       if self._fresh(entry)}
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as fh:
+                json.dump(entries, fh)
+            os.replace(temporary, self.path)
+            self._dirty = False
+
+    def report(self):
+        return 'OMDB cache: {} hits, {} misses'.format(self.hits, self.misses)
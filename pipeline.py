@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Hand-off between the sampling loop and the threads doing network I/O.
+"""
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class BoundedQueue(object):
+    """
+    A queue.Queue of at most `size` items with a policy for what `put` does
+    when it is full: discard the oldest item, discard the new item, or block
+    until there is room. Pass `factory=multiprocessing.Queue` to share it
+    between processes.
+    """
+    def __init__(self, size=10000, overflow=DROP_OLDEST, factory=queue.Queue):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy "{}"; expected one of '
+                             '{}'.format(overflow, OVERFLOW_POLICIES))
+        self.overflow = overflow
+        self.dropped = 0
+        self._queue = factory(maxsize=size)
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, item):
+        if self.overflow == BLOCK:
+            self._queue.put(item)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                self._count_drop()
+                if self.overflow == DROP_NEWEST:
+                    return
+
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+
+    def _count_drop(self):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            log.warning('Queue full; {} items dropped so far ({})'.format(
+                self.dropped, self.overflow))
+
+    def get(self, timeout=None):
+        """Returns the next item or None after waiting `timeout` seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_nowait(self):
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+
+class WriterThread(threading.Thread):
+    """
+    Drains `items` into `writer`, an object with add/flush_if_due/flush such
+    as influxsink.BatchWriter, so slow writes never delay the producer.
+    """
+    def __init__(self, items, writer, poll_interval=1, name='writer'):
+        super(WriterThread, self).__init__(name=name, daemon=True)
+        self.items = items
+        self.writer = writer
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            item = self.items.get(timeout=self.poll_interval)
+            while item is not None:
+                self.writer.add(item)
+                item = self.items.get_nowait()
+            self.writer.flush_if_due()
+
+        item = self.items.get_nowait()
+        while item is not None:
+            self.writer.add(item)
+            item = self.items.get_nowait()
+        self.writer.flush()
+
+    def stop(self, timeout=None):
+        """Writes whatever is still queued and waits for the thread to end."""
+        self._stopping.set()
+        self.join(timeout)
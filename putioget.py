@@ -16,21 +16,24 @@ downloaded_files = DumbDB('downloaded_before.txt')
 
 
 def get_missing_files(file_resources):
+    file_resources = list(file_resources)
+    downloaded = downloaded_files.exists_many(
+        file_resource.id for file_resource in file_resources)
+
     missing_files = []
-    for file_resource in file_resources:
+    for file_resource, is_downloaded in zip(file_resources, downloaded):
         log.debug(
             ' ↦ Analysing %s %d %s', file_resource.file_type, file_resource.id,
             file_resource.name)
 
-        log.debug(
-            '   ↦ Maybe wanted %d %s', file_resource.id, file_resource.name)
-
-        if downloaded_files.exists(file_resource.id):
+        if is_downloaded:
             continue
 
+        log.debug(
+            '   ↦ Wanted %d %s', file_resource.id, file_resource.name)
         missing_files.append(file_resource)
 
-        log.debug('Partial wanted\n%s', missing_files)
+    log.debug('Wanted %d of %d files', len(missing_files), len(file_resources))
     return missing_files
 
 
@@ -68,7 +71,11 @@ def aria2_download(url, dir='/home/thiago/putio'):
     return False
 
 
-for f in get_missing_videos():
-    if aria2_download(f.get_download_link()):
-        log.info(f'Added {f.id} ({f.name}) to aria2 queue')
-        downloaded_files.add(f.id)
+try:
+    for f in get_missing_videos():
+        if aria2_download(f.get_download_link()):
+            log.info(f'Added {f.id} ({f.name}) to aria2 queue')
+            # written straight away, so a killed run does not queue it again
+            downloaded_files.add(f.id)
+finally:
+    downloaded_files.close()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Drift-free periodic scheduling on the monotonic clock.
+
+Every task has an absolute deadline that advances by exactly its interval,
+so time spent doing the work does not accumulate into the period. When work
+finishes after the following deadline has already passed the missed periods
+are skipped (keeping the original phase) and counted as overruns.
+"""
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """
+    Schedules objects with `id` and `interval` attributes, e.g.
+    w1sensors.SensorHandle.
+    """
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.overruns = 0
+        self._deadlines = {}
+
+    def due(self, tasks):
+        """
+        Returns the tasks whose deadline has passed. Tasks not seen before
+        are due immediately; deadlines of tasks no longer given are dropped.
+        """
+        now = self.clock()
+        ids = set()
+        due = []
+        for task in tasks:
+            ids.add(task.id)
+            deadline = self._deadlines.setdefault(task.id, now)
+            if deadline <= now:
+                due.append(task)
+
+        for task_id in self._deadlines.keys() - ids:
+            del self._deadlines[task_id]
+
+        return due
+
+    def complete(self, tasks):
+        """Advances the deadline of each task that has just been run."""
+        now = self.clock()
+        for task in tasks:
+            deadline = self._deadlines.get(task.id)
+            if deadline is None:
+                continue
+
+            deadline += task.interval
+            if deadline <= now:
+                missed = int((now - deadline) // task.interval) + 1
+                deadline += missed * task.interval
+                self.overruns += missed
+                log.warning('"{}" overran its {}s interval; skipped {} '
+                            'sample(s)'.format(task.id, task.interval, missed))
+            self._deadlines[task.id] = deadline
+
+    def next_deadline(self):
+        if not self._deadlines:
+            return None
+        return min(self._deadlines.values())
+
+    def wait(self, default=1, maximum=None):
+        """
+        Sleeps until the earliest deadline, or `default` seconds if none, but
+        no longer than `maximum` seconds.
+        """
+        deadline = self.next_deadline()
+        if deadline is None:
+            delay = default
+        else:
+            delay = deadline - self.clock()
+        if maximum is not None:
+            delay = min(delay, maximum)
+
+        if delay > 0:
+            self.sleep(delay)
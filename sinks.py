@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+Outputs for the readings produced by collector.collect.
+
+Every output is fed by its own bounded queue and writer thread (see FanOut),
+so a slow or unreachable output never delays sampling or the other outputs.
+Outputs are configured in a yaml file, one entry per output:
+---
+<name>:
+  type: influxdb | csv | tsstore | graphite | stdout
+  queue:               # optional, see pipeline.BoundedQueue
+    size: 10000
+    overflow: drop_oldest
+  <type specific settings>
+
+influxdb takes 'config', the InfluxDB configuration file; the settings of the
+other types are the arguments of CsvOutput, TsStoreOutput, GraphiteOutput and
+StdoutOutput.
+These name a sensor after its 'name_tag' tag [default: location], or its id
+without one. CSV files and tsstore histories hold degrees Celsius, whatever
+the 'scale' of a sensor, as written by ds18b20.py.
+"""
+import datetime
+import logging
+import os
+import pickle
+import platform
+import pprint
+import socket
+import struct
+import time
+
+import yaml
+
+from lineprotocol import scale_index
+from pipeline import BoundedQueue, WriterThread
+
+log = logging.getLogger(__name__)
+
+UNITS = ('°C', '°F', 'K')
+# a reading in each scale, indexed like lineprotocol.SCALES, to Celsius
+TO_CELSIUS = (
+    lambda value: value,
+    lambda value: (value - 32) / 1.8,
+    lambda value: value - 273.15,
+)
+
+
+def read_yaml(filename, description):
+    try:
+        with open(filename, 'r') as fh:
+            return yaml.safe_load(fh) or {}
+    except IOError:
+        log.info('Could not read {} from {}'.format(description, filename))
+        return {}
+
+
+def read_influxdb_config(config_filename):
+    return read_yaml(config_filename, 'InfluxDB configuration')
+
+
+def read_sinks_config(config_filename):
+    return read_yaml(config_filename, 'sink configuration')
+
+
+def sensor_name(reading, name_tag):
+    return str(reading.tags.get(name_tag, reading.sensor_id))
+
+
+def celsius(reading):
+    """The value of `reading` in degrees Celsius, to a millidegree."""
+    index = scale_index(reading.tags.get('scale'))
+    return round(TO_CELSIUS[index](reading.value), 3)
+
+
+def to_timestamp(text):
+    """Milliseconds since the epoch of an ISO 8601 local time."""
+    return int(datetime.datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def parse_csv_line(line):
+    """(name, timestamp in ms, value) of a CsvOutput line, or None."""
+    taken, _, reading = line.strip().partition(',')
+    name, _, value = reading.rpartition('=')
+    if not name:
+        return None
+    try:
+        return name, to_timestamp(taken), float(value)
+    except ValueError:
+        return None
+
+
+class InfluxDBOutput(object):
+    """
+    Batches line-protocol records to InfluxDB through influxsink.BatchWriter,
+    spooling them to disk while it is unreachable. Records without a sensor,
+    such as collector_stats, are only written by this output.
+    """
+    def __init__(self, config, stats=None):
+        from influxsink import BatchWriter, influxdb_sink, write_measurement
+        from spool import Spool, SpoolReplayer
+
+        config = dict(config)
+        batch_config = config.pop('batch', None) or {}
+        spool_config = config.pop('spool', None)
+        self.queue_config = config.pop('queue', None) or {}
+
+        log.debug('Connecting to InfluxDB with: "{}"'.format(
+            pprint.pformat(config)))
+        sink = influxdb_sink(**config)
+        log.debug('Writing through {}'.format(sink))
+        sink.ensure_database()
+
+        data_spool = None
+        self.replayer = None
+        if spool_config is not None:
+            spool_config = dict(spool_config)
+            replay_batch = spool_config.pop('replay_batch', 5000)
+            replay_interval = spool_config.pop('replay_interval', 30)
+            data_spool = Spool(**spool_config)
+            self.replayer = SpoolReplayer(
+                data_spool, lambda lines: write_measurement(lines, sink),
+                batch_size=replay_batch, interval=replay_interval)
+            self.replayer.start()
+
+        self.writer = BatchWriter(
+            sink, spool=data_spool, stats=stats, replayer=self.replayer,
+            **batch_config)
+
+    def add(self, reading):
+        self.writer.add(reading.line)
+
+    def flush_if_due(self):
+        self.writer.flush_if_due()
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        if self.replayer is not None:
+            self.replayer.stop()
+
+
+class CsvOutput(object):
+    """
+    Appends '<isoformat time>,<name>=<celsius>' lines to `path`, which is kept
+    open with a `buffer_size` byte write buffer and flushed every
+    `flush_interval` seconds. The file is rotated to '<path>.<date>' when a
+    reading from a new day arrives (with `daily`) or when it grows beyond
+    `max_bytes` (0 disables).
+    """
+    def __init__(self, path='temperature.csv', name_tag='location',
+                 buffer_size=65536, flush_interval=5, daily=False,
+                 max_bytes=0):
+        self.path = path
+        self.name_tag = name_tag
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.daily = daily
+        self.max_bytes = max_bytes
+        self._fh = None
+        self._day = None
+        self._flushed = time.monotonic()
+
+    def _open(self):
+        self._fh = open(self.path, 'a', buffering=self.buffer_size)
+        if self._fh.tell():
+            self._day = datetime.date.fromtimestamp(
+                os.path.getmtime(self.path))
+        else:
+            self._day = None
+
+    def _rotate(self):
+        self.close()
+        day = self._day or datetime.date.today()
+        rotated = '{}.{}'.format(self.path, day.isoformat())
+        suffix = 0
+        while os.path.exists(rotated):
+            suffix += 1
+            rotated = '{}.{}.{}'.format(self.path, day.isoformat(), suffix)
+        os.rename(self.path, rotated)
+        log.info('Rotated {} to {}'.format(self.path, rotated))
+        self._open()
+
+    def add(self, reading):
+        if reading.sensor_id is None:
+            return
+        if self._fh is None:
+            self._open()
+
+        taken = datetime.datetime.fromtimestamp(reading.timestamp / 1000)
+        if self._day is not None and (
+                (self.daily and taken.date() != self._day) or
+                (self.max_bytes and self._fh.tell() >= self.max_bytes)):
+            self._rotate()
+        if self._day is None:
+            self._day = taken.date()
+
+        name = sensor_name(reading, self.name_tag)
+        self._fh.write('{},{}={}\n'.format(
+            taken.isoformat(), name, celsius(reading)))
+
+    def flush_if_due(self):
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        if self._fh is not None:
+            self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class TsStoreOutput(object):
+    """
+    Appends readings to the tsstore.TimeSeriesStore in `directory`, flushed
+    every `flush_interval` seconds.
+    """
+    def __init__(self, directory='history', name_tag='location',
+                 flush_interval=5):
+        from tsstore import TimeSeriesStore
+
+        self.store = TimeSeriesStore(directory)
+        self.name_tag = name_tag
+        self.flush_interval = flush_interval
+        self._flushed = time.monotonic()
+
+    def add(self, reading):
+        if reading.sensor_id is None:
+            return
+        self.store.append(sensor_name(reading, self.name_tag),
+                          reading.timestamp, celsius(reading))
+
+    def flush_if_due(self):
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+class GraphiteOutput(object):
+    """
+    Sends '<namespace>.<prefix><name>' metrics to Carbon in batches over one
+    persistent TCP connection, as plaintext lines or, with protocol 'pickle',
+    as pickled lists for Carbon's pickle receiver (usually port 2004).
+
+    A batch is sent once `batch_size` metrics are buffered or the oldest is
+    `max_age` seconds old; with the default of 0 everything drained from the
+    queue in one go is sent together. While Carbon is unreachable up to
+    `max_buffer` metrics are kept and a reconnect is tried at most every
+    `reconnect_interval` seconds. `namespace` defaults to graphitesend's
+    'systems.<hostname>'.
+    """
+    def __init__(self, host='localhost', port=2003, prefix='temp_',
+                 namespace=None, protocol='plaintext', batch_size=500,
+                 max_age=0, max_buffer=10000, timeout=5,
+                 reconnect_interval=10, name_tag='location'):
+        if protocol not in ('plaintext', 'pickle'):
+            raise ValueError('Unknown Graphite protocol "{}"; expected '
+                             'plaintext or pickle'.format(protocol))
+        if namespace is None:
+            namespace = 'systems.' + platform.node()
+        self.address = (host, port)
+        self.prefix = prefix
+        if namespace:
+            self.prefix = namespace + '.' + prefix
+        self.protocol = protocol
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_buffer = max_buffer
+        self.timeout = timeout
+        self.reconnect_interval = reconnect_interval
+        self.name_tag = name_tag
+        self.dropped = 0
+        self._socket = None
+        self._next_connect = 0
+        self._metrics = []
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._metrics)
+
+    def add(self, reading):
+        if reading.sensor_id is None:
+            return
+        if not self._metrics:
+            self._oldest = time.monotonic()
+        elif len(self._metrics) >= self.max_buffer:
+            del self._metrics[0]
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                log.warning('Graphite buffer full; {} metrics dropped so '
+                            'far'.format(self.dropped))
+
+        name = sensor_name(reading, self.name_tag).replace(' ', '_')
+        self._metrics.append(
+            (self.prefix + name, reading.timestamp // 1000, reading.value))
+        if len(self._metrics) >= self.batch_size:
+            self.flush()
+
+    def is_due(self):
+        if not self._metrics:
+            return False
+        if len(self._metrics) >= self.batch_size:
+            return True
+        return (time.monotonic() - self._oldest) >= self.max_age
+
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    def _connect(self):
+        if time.monotonic() < self._next_connect:
+            return False
+        try:
+            self._socket = socket.create_connection(
+                self.address, timeout=self.timeout)
+        except OSError as e:
+            self._next_connect = time.monotonic() + self.reconnect_interval
+            log.warning('Could not connect to Carbon at {}:{}: {}'.format(
+                self.address[0], self.address[1], e))
+            return False
+
+        log.info('Connected to Carbon at {}:{}'.format(*self.address))
+        return True
+
+    def _payload(self, metrics):
+        if self.protocol == 'pickle':
+            data = pickle.dumps(
+                [(path, (timestamp, value))
+                 for path, timestamp, value in metrics], protocol=2)
+            return struct.pack('!L', len(data)) + data
+
+        return ''.join('%s %r %d\n' % (path, value, timestamp)
+                       for path, timestamp, value in metrics).encode('utf-8')
+
+    def flush(self):
+        if not self._metrics:
+            return True
+        if self._socket is None and not self._connect():
+            return False
+
+        while self._metrics:
+            metrics = self._metrics[:self.batch_size]
+            try:
+                self._socket.sendall(self._payload(metrics))
+            except OSError as e:
+                log.warning('Lost connection to Carbon: {}'.format(e))
+                self.close()
+                return False
+            del self._metrics[:len(metrics)]
+
+        return True
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class StdoutOutput(object):
+    """Prints 'Sensor <name>: <value><unit>' for every reading."""
+    def __init__(self, name_tag='location'):
+        self.name_tag = name_tag
+
+    def add(self, reading):
+        if reading.sensor_id is None:
+            return
+        name = sensor_name(reading, self.name_tag)
+        unit = UNITS[scale_index(reading.tags.get('scale'))]
+        print('Sensor {}: {}{}'.format(name, reading.value, unit), flush=True)
+
+    def flush_if_due(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+OUTPUT_TYPES = {
+    'csv': CsvOutput,
+    'graphite': GraphiteOutput,
+    'stdout': StdoutOutput,
+    'tsstore': TsStoreOutput,
+}
+
+
+def make_output(name, settings, stats=None):
+    """Returns (output, queue settings) for one entry of the sinks file."""
+    settings = dict(settings or {})
+    output_type = settings.pop('type', name)
+    queue_config = settings.pop('queue', None) or {}
+
+    if output_type == 'influxdb':
+        influx_config = read_influxdb_config(
+            settings.pop('config', 'influxdb-config.yaml'))
+        output = InfluxDBOutput(influx_config, stats=stats)
+        return output, queue_config or output.queue_config
+
+    if output_type not in OUTPUT_TYPES:
+        raise ValueError('Unknown type "{}" of sink "{}"; expected influxdb '
+                         'or one of {}'.format(output_type, name,
+                                               sorted(OUTPUT_TYPES)))
+    return OUTPUT_TYPES[output_type](**settings), queue_config
+
+
+def make_outputs(config, stats=None):
+    """{name: (output, queue settings)} for a parsed sinks file."""
+    return {name: make_output(name, settings, stats)
+            for name, settings in config.items()}
+
+
+class FanOut(object):
+    """
+    Delivers every reading to each output through that output's own
+    BoundedQueue and WriterThread. Usable both as the `readings` of
+    collector.collect and as the writer of a WriterThread draining a shared
+    queue.
+    """
+    def __init__(self, outputs):
+        self.outputs = {}
+        self.queues = {}
+        self.threads = {}
+        for name, (output, queue_config) in sorted(outputs.items()):
+            self.outputs[name] = output
+            self.queues[name] = BoundedQueue(**queue_config)
+            self.threads[name] = WriterThread(
+                self.queues[name], output, name='sink-' + name)
+
+    def __len__(self):
+        return max([len(items) for items in self.queues.values()] or [0])
+
+    @property
+    def dropped(self):
+        return sum(items.dropped for items in self.queues.values())
+
+    def put(self, reading):
+        for items in self.queues.values():
+            items.put(reading)
+
+    add = put
+
+    def flush_if_due(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def start(self):
+        for thread in self.threads.values():
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Writes what is still queued to every output and closes them."""
+        for name, thread in self.threads.items():
+            thread.stop(timeout)
+            self.outputs[name].close()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded on-disk spool for line-protocol records that could not be written.
+
+Records are appended to segment files named by sequence number. A segment is
+closed once it reaches `segment_size` bytes and the oldest segments are
+discarded when the spool grows beyond `max_size` bytes, so both disk usage
+and SD card writes stay bounded. Nothing is written while InfluxDB accepts
+the records.
+"""
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.seg'
+
+
+class Spool(object):
+    def __init__(self, directory='spool', segment_size=1024 * 1024,
+                 max_size=64 * 1024 * 1024, fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._segments = self._existing_segments()
+        self._current = None
+        if self._segments:
+            log.info('Spool {} holds {} segments from a previous run'.format(
+                directory, len(self._segments)))
+
+    def _existing_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _path(self, sequence):
+        return os.path.join(
+            self.directory, '{:012d}{}'.format(sequence, SEGMENT_SUFFIX))
+
+    def _size(self, sequence):
+        try:
+            return os.path.getsize(self._path(sequence))
+        except FileNotFoundError:
+            return 0
+
+    def _total_size(self):
+        return sum(self._size(sequence) for sequence in self._segments)
+
+    def _open_segment(self):
+        sequence = self._segments[-1] + 1 if self._segments else 0
+        self._segments.append(sequence)
+        self._current = sequence
+        log.debug('Opened spool segment {}'.format(self._path(sequence)))
+
+    def _seal(self):
+        self._current = None
+
+    def _enforce_max_size(self):
+        total = self._total_size()
+        while total > self.max_size and len(self._segments) > 1:
+            sequence = self._segments.pop(0)
+            size = self._size(sequence)
+            os.remove(self._path(sequence))
+            total -= size
+            log.warning('Spool is full; dropped {} bytes of the oldest '
+                        'records'.format(size))
+
+    def __len__(self):
+        return len(self._segments)
+
+    def append(self, lines):
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        with self._lock:
+            if self._current is None or \
+                    self._size(self._current) >= self.segment_size:
+                self._open_segment()
+                self._enforce_max_size()
+
+            fd = os.open(self._path(self._current),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        log.info('Spooled {} records'.format(len(lines)))
+
+    def oldest(self):
+        """
+        Returns (sequence, lines) for the oldest segment, or (None, []) when
+        the spool is empty. The segment being appended to is closed first so
+        replay never races with new records.
+        """
+        with self._lock:
+            if not self._segments:
+                return None, []
+            sequence = self._segments[0]
+            if sequence == self._current:
+                self._seal()
+
+        try:
+            with open(self._path(sequence), 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return sequence, []
+
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        # the last element is either empty or a record cut short by a crash
+        return sequence, [line for line in lines[:-1] if line]
+
+    def remove(self, sequence):
+        with self._lock:
+            if sequence in self._segments:
+                self._segments.remove(sequence)
+            try:
+                os.remove(self._path(sequence))
+            except FileNotFoundError:
+                pass
+
+
+class SpoolReplayer(threading.Thread):
+    """
+    Sends spooled records back to InfluxDB in chunks of `batch_size` through
+    `write` (a callable taking a list of lines and returning True on success)
+    and retries every `interval` seconds while InfluxDB is unreachable.
+
+    A segment is removed only after all of its chunks were written; if a
+    later chunk fails the earlier ones are sent again, which InfluxDB treats
+    as an overwrite of identical points.
+    """
+    def __init__(self, spool, write, batch_size=5000, interval=30):
+        super(SpoolReplayer, self).__init__(name='spool-replay', daemon=True)
+        self.spool = spool
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._wake = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def replay_segment(self):
+        sequence, lines = self.spool.oldest()
+        if sequence is None:
+            return False
+
+        for start in range(0, len(lines), self.batch_size):
+            if not self.write(lines[start:start + self.batch_size]):
+                return False
+
+        log.info('Replayed {} spooled records'.format(len(lines)))
+        self.spool.remove(sequence)
+        return True
+
+    def run(self):
+        while not self._stopping.is_set():
+            while not self._stopping.is_set() and self.replay_segment():
+                pass
+            self._wake.wait(self.interval)
+            self._wake.clear()
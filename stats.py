@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Self-instrumentation of the temperature collector.
+
+Counters and observations are cumulative; each observation also keeps the
+maximum seen since the last `collector_stats` report. Values can be tagged
+with a sensor id. Reports are written to InfluxDB as
+
+collector_stats[,sensor_id=<id>] <name>=<value>,<name>_count=<n>i,...
+
+and can be served in the Prometheus text format by MetricsServer.
+"""
+import http.server
+import logging
+import threading
+
+from lineprotocol import format_tags
+
+log = logging.getLogger(__name__)
+
+MEASUREMENT = 'collector_stats'
+
+
+class Stats(object):
+    """`tags` are added to every collector_stats record."""
+    def __init__(self, tags=None):
+        self.tags = dict(tags or {})
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._observations = {}
+        self._gauges = {}
+
+    def count(self, name, sensor_id=None, increment=1):
+        key = (name, sensor_id)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + increment
+
+    def observe(self, name, value, sensor_id=None):
+        """Records a latency, size or similar; keeps count, sum and max."""
+        key = (name, sensor_id)
+        with self._lock:
+            observation = self._observations.get(key)
+            if observation is None:
+                self._observations[key] = [1, value, value]
+                return
+            observation[0] += 1
+            observation[1] += value
+            if value > observation[2]:
+                observation[2] = value
+
+    def gauge(self, name, read):
+        """Registers `read`, a callable returning the current value."""
+        self._gauges[(name, None)] = read
+
+    def _fields(self, reset_max):
+        fields = {}
+        with self._lock:
+            for (name, sensor_id), value in self._counters.items():
+                fields.setdefault(sensor_id, {})[name] = ('%di', value)
+            for (name, sensor_id), observation in self._observations.items():
+                count, total, maximum = observation
+                sensor_fields = fields.setdefault(sensor_id, {})
+                sensor_fields[name + '_count'] = ('%di', count)
+                sensor_fields[name + '_sum'] = ('%r', float(total))
+                sensor_fields[name + '_max'] = ('%r', float(maximum))
+                if reset_max:
+                    observation[2] = 0
+        for (name, sensor_id), read in self._gauges.items():
+            try:
+                fields.setdefault(sensor_id, {})[name] = ('%r', read())
+            except Exception as e:
+                log.debug('Could not read gauge {}: {}'.format(name, e))
+
+        return fields
+
+    def lines(self, timestamp):
+        """collector_stats records for InfluxDB; resets the maximums."""
+        lines = []
+        for sensor_id, fields in self._fields(reset_max=True).items():
+            tags = dict(self.tags)
+            if sensor_id is not None:
+                tags['sensor_id'] = sensor_id
+            values = ','.join(
+                name + '=' + fmt % value
+                for name, (fmt, value) in sorted(fields.items()))
+            lines.append('%s%s %s %d' % (
+                MEASUREMENT, format_tags(tags), values, timestamp))
+
+        return lines
+
+    def prometheus_text(self):
+        output = []
+        for sensor_id, fields in self._fields(reset_max=False).items():
+            labels = '' if sensor_id is None else \
+                '{sensor_id="%s"}' % sensor_id
+            for name, (_, value) in sorted(fields.items()):
+                output.append('{}_{}{} {}'.format(
+                    MEASUREMENT, name, labels, value))
+
+        return '\n'.join(sorted(output)) + '\n'
+
+
+class StatsReporter(threading.Thread):
+    """Every `interval` seconds hands `stats` records to `emit`."""
+    def __init__(self, stats, emit, timestamp, interval=60):
+        super(StatsReporter, self).__init__(name='stats', daemon=True)
+        self.stats = stats
+        self.emit = emit
+        self.timestamp = timestamp
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            for line in self.stats.lines(self.timestamp()):
+                self.emit(line)
+
+    def stop(self):
+        self._stopping.set()
+
+
+class MetricsServer(threading.Thread):
+    """Serves `stats` in the Prometheus text format at /metrics."""
+    def __init__(self, stats, port, host='127.0.0.1'):
+        super(MetricsServer, self).__init__(name='metrics', daemon=True)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = stats.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        log.info('Serving metrics on port {}'.format(
+            self.server.server_address[1]))
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
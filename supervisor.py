@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Runs sensor collection in one worker process per shard and restarts workers
+that die or stop reporting progress.
+
+A shard is either one 1-Wire bus master (w1_bus_masterN, whose sensors are
+listed in its own sysfs directory) or a fixed share of all sensors, so one
+stuck bus only stalls its own worker.
+
+Every worker hands its readings to the supervisor through a queue of its
+own, created afresh each time it starts. Killing a hung worker can corrupt
+the queue it was writing to, so that queue is abandoned with it and no other
+worker depends on it.
+"""
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+
+from pipeline import BoundedQueue, WriterThread
+from w1sensors import W1_DEVICES_PATH
+
+log = logging.getLogger(__name__)
+
+
+class Shard(object):
+    """
+    The sensors under `devices_path` whose id hashes to `index` out of
+    `count` groups.
+    """
+    def __init__(self, name, devices_path=W1_DEVICES_PATH, index=0, count=1):
+        self.name = name
+        self.devices_path = devices_path
+        self.index = index
+        self.count = count
+
+    def __repr__(self):
+        return 'Shard({})'.format(self.name)
+
+    def includes(self, sensor_id):
+        if self.count == 1:
+            return True
+        return zlib.crc32(sensor_id.encode('utf-8')) % self.count == self.index
+
+
+def bus_shards(devices_path=W1_DEVICES_PATH):
+    return [Shard(name, os.path.join(devices_path, name))
+            for name in sorted(os.listdir(devices_path))
+            if name.startswith('w1_bus_master')]
+
+
+def group_shards(count, devices_path=W1_DEVICES_PATH):
+    return [Shard('group{}'.format(index), devices_path, index, count)
+            for index in range(count)]
+
+
+class Worker(object):
+    def __init__(self, shard, target, args, readings, queue_config):
+        self.shard = shard
+        self.target = target
+        self.args = args
+        self.readings = readings
+        self.queue_config = queue_config
+        self.heartbeat = multiprocessing.Value('d', 0.0, lock=False)
+        self.process = None
+        self.drain = None
+        self.restarts = -1
+
+    def start(self):
+        channel = BoundedQueue(
+            factory=multiprocessing.Queue, **self.queue_config)
+        self.drain = WriterThread(
+            channel, self.readings, name='drain-' + self.shard.name)
+        self.drain.start()
+        self.heartbeat.value = time.monotonic()
+        self.process = multiprocessing.Process(
+            target=self.target, name='shard-' + self.shard.name,
+            args=(self.shard, self.heartbeat, channel) + self.args,
+            daemon=True)
+        self.process.start()
+        self.restarts += 1
+        log.info('Started worker {} for {}'.format(
+            self.process.pid, self.shard))
+
+    def stop_drain(self, timeout=5):
+        """Hands what is left in the worker's queue on, then abandons it."""
+        self.drain.stop(timeout)
+        if self.drain.is_alive():
+            log.warning('Abandoned the queue of {}'.format(self.shard))
+
+    def silence(self):
+        """Seconds since the worker last updated its heartbeat."""
+        return time.monotonic() - self.heartbeat.value
+
+    def kill(self, timeout=5):
+        self.process.terminate()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class Supervisor(object):
+    """
+    Starts `target(shard, heartbeat, channel, *args)` in a process per shard.
+    Workers put their readings into `channel`, a BoundedQueue made with
+    `queue_config`, whose items this process adds to `readings`. Workers
+    must set `heartbeat.value = time.monotonic()` at least every
+    `hang_timeout` seconds; a worker that exits or stays silent longer than
+    that is restarted.
+    """
+    def __init__(self, shards, target, readings, args=(), queue_config=None,
+                 hang_timeout=30, poll_interval=1):
+        self.workers = [
+            Worker(shard, target, args, readings, queue_config or {})
+            for shard in shards]
+        self.hang_timeout = hang_timeout
+        self.poll_interval = poll_interval
+
+    def check(self):
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                log.error('Worker for {} exited with {}; restarting'.format(
+                    worker.shard, worker.process.exitcode))
+                worker.stop_drain()
+                worker.start()
+            elif worker.silence() > self.hang_timeout:
+                log.error('Worker for {} hung for {:.0f}s; restarting'.format(
+                    worker.shard, worker.silence()))
+                worker.kill()
+                worker.stop_drain()
+                worker.start()
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+        while True:
+            time.sleep(self.poll_interval)
+            self.check()
+
+    def stop(self, timeout=10):
+        """Waits for workers to finish (e.g. after SIGINT), then kills them."""
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.kill()
+            worker.stop_drain()
@@ -0,0 +1,226 @@
+"""
+Moves files into another directory, several at a time.
+
+Within one filesystem a move is a rename. Across filesystems the file is
+copied to a temporary name next to its destination, with os.copy_file_range
+or os.sendfile when the kernel supports them between the two filesystems and
+with large buffered reads and writes otherwise. The copy is renamed into
+place, and the source removed, only once its size matches.
+
+Renames into place never replace an existing file: they hard link the file
+to its destination, which fails if the name is taken, and then remove the
+old name. Only where hard links are not supported is the check followed by
+a plain rename; moves to the same destination are serialised within the
+process either way.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 8 * 1024 * 1024
+PART_SUFFIX = '.part'
+# errors meaning a zero-copy call is not supported for this pair of files
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTSUP, errno.EBADF)
+# errors meaning the filesystem has no hard links
+NO_LINKS = (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+Transfer = collections.namedtuple(
+    'Transfer', 'source destination size seconds method')
+
+
+class TransferError(Exception):
+    pass
+
+
+_moving = set()
+_moving_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _claim(destination):
+    """Fails if another thread is already moving a file to `destination`."""
+    with _moving_lock:
+        if destination in _moving:
+            raise TransferError('Already being moved: {}'.format(destination))
+        _moving.add(destination)
+    try:
+        yield
+    finally:
+        with _moving_lock:
+            _moving.discard(destination)
+
+
+def rename_new(path, destination):
+    """Renames `path` to `destination` unless `destination` exists."""
+    try:
+        os.link(path, destination)
+    except FileExistsError:
+        raise TransferError('Already exists: {}'.format(destination))
+    except OSError as e:
+        if e.errno not in NO_LINKS:
+            raise
+        if os.path.lexists(destination):
+            raise TransferError('Already exists: {}'.format(destination))
+        os.rename(path, destination)
+        return
+    os.unlink(path)
+
+
+def _copy_file_range(source_fd, destination_fd, size):
+    copied = 0
+    while copied < size:
+        sent = os.copy_file_range(source_fd, destination_fd, CHUNK_SIZE)
+        if not sent:
+            break
+        copied += sent
+    return copied
+
+
+def _sendfile(source_fd, destination_fd, size):
+    copied = 0
+    while copied < size:
+        sent = os.sendfile(destination_fd, source_fd, copied, CHUNK_SIZE)
+        if not sent:
+            break
+        copied += sent
+    return copied
+
+
+def _read_write(source_fd, destination_fd, size):
+    copied = 0
+    with open(source_fd, 'rb', buffering=0, closefd=False) as source, \
+            open(destination_fd, 'wb', buffering=0, closefd=False) as dest:
+        buffer = bytearray(BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            read = source.readinto(buffer)
+            if not read:
+                break
+            dest.write(view[:read])
+            copied += read
+    return copied
+
+
+COPY_METHODS = [
+    ('copy_file_range', getattr(os, 'copy_file_range', None)
+     and _copy_file_range),
+    ('sendfile', getattr(os, 'sendfile', None) and _sendfile),
+    ('read/write', _read_write),
+]
+
+
+def copy_data(source_fd, destination_fd, size):
+    """Copies with the fastest method that works; returns its name."""
+    for name, method in COPY_METHODS:
+        if method is None:
+            continue
+        try:
+            copied = method(source_fd, destination_fd, size)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            log.debug('{} not usable ({}); falling back'.format(name, e))
+            os.lseek(source_fd, 0, os.SEEK_SET)
+            os.lseek(destination_fd, 0, os.SEEK_SET)
+            os.ftruncate(destination_fd, 0)
+            continue
+        if copied != size:
+            raise TransferError('copied {} of {} bytes'.format(copied, size))
+        return name
+
+    raise TransferError('no copy method available')
+
+
+def copy_file(source, destination):
+    """Copies `source` to `destination` via a temporary file next to it."""
+    temporary = destination + PART_SUFFIX
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        size = os.fstat(source_fd).st_size
+        destination_fd = os.open(
+            temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            method = copy_data(source_fd, destination_fd, size)
+            os.fsync(destination_fd)
+            copied = os.fstat(destination_fd).st_size
+        finally:
+            os.close(destination_fd)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+    finally:
+        os.close(source_fd)
+
+    if copied != size:
+        os.unlink(temporary)
+        raise TransferError('{}: copy has {} of {} bytes'.format(
+            source, copied, size))
+    shutil.copystat(source, temporary)
+    try:
+        rename_new(temporary, destination)
+    except TransferError:
+        os.unlink(temporary)
+        raise
+    return size, method
+
+
+def move_file(source, target_dir):
+    """
+    Moves `source` into `target_dir`, creating it if needed, and returns a
+    Transfer. Raises TransferError if the destination already exists.
+    """
+    source = str(source)
+    target_dir = str(target_dir)
+    destination = os.path.join(target_dir, os.path.basename(source))
+    with _claim(destination):
+        if os.path.lexists(destination):
+            raise TransferError('Already exists: {}'.format(destination))
+        os.makedirs(target_dir, mode=0o777, exist_ok=True)
+
+        start = time.monotonic()
+        size = os.stat(source).st_size
+        if os.stat(source).st_dev == os.stat(target_dir).st_dev:
+            rename_new(source, destination)
+            method = 'rename'
+        else:
+            size, method = copy_file(source, destination)
+            os.unlink(source)
+
+    return Transfer(source, destination, size, time.monotonic() - start,
+                    method)
+
+
+def throughput(transfer):
+    """Human readable size, time and rate of a Transfer."""
+    megabytes = transfer.size / 1e6
+    if transfer.method == 'rename':
+        return '{:.1f} MB renamed'.format(megabytes)
+    return '{:.1f} MB in {:.1f}s, {:.1f} MB/s ({})'.format(
+        megabytes, transfer.seconds,
+        megabytes / transfer.seconds if transfer.seconds else float('inf'),
+        transfer.method)
+
+
+class Mover(object):
+    """Runs up to `workers` move_file calls at the same time."""
+    def __init__(self, workers=2):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='mover')
+
+    def submit(self, source, target_dir):
+        """Returns a future of the Transfer."""
+        return self.executor.submit(move_file, source, target_dir)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact local store for temperature history.
+
+Usage: tsstore.py query <directory> [-s <name>]... [--start <time>]
+                        [--end <time>] [--summary]
+       tsstore.py import <directory> <csv>...
+
+Options:
+    -s <name>       Only return readings of this sensor; may be repeated.
+    --start <time>  Earliest reading to return, as an ISO 8601 local time.
+    --end <time>    Return readings taken before this ISO 8601 local time.
+    --summary       Print count, min, mean and max per sensor instead.
+    -h, --help      Print help.
+
+'query' prints readings in the '<isoformat time>,<name>=<value>' format of
+temperature.csv; 'import' appends such files to the store.
+
+A store is a directory of append-only segment files, one per UTC day, named
+<YYYY-MM-DD>.tsd. Each segment starts with a 16 byte header (magic, version,
+record size and the start of the day in milliseconds) followed by fixed-width
+14 byte records: timestamp in milliseconds (int64), sensor index (uint16) and
+value in milli-degrees (int32), all little-endian. Sensor names are listed
+one per line, in index order, in the 'sensors' file of the directory.
+
+Segments are read memory-mapped into NumPy structured arrays, so scanning
+months of readings involves no parsing at all.
+"""
+import datetime
+import logging
+import os
+import struct
+import sys
+
+import numpy
+
+from docopt import docopt
+
+from sinks import parse_csv_line, to_timestamp
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'TSD1'
+VERSION = 1
+HEADER = struct.Struct('<4sHHq')
+RECORD = numpy.dtype([
+    ('timestamp', '<i8'), ('sensor', '<u2'), ('value', '<i4')])
+DAY = 86400000
+SEGMENT_SUFFIX = '.tsd'
+SENSORS_FILE = 'sensors'
+
+
+class StoreError(Exception):
+    pass
+
+
+def day_start(timestamp):
+    return timestamp - timestamp % DAY
+
+
+def segment_name(start):
+    day = datetime.datetime.fromtimestamp(
+        start / 1000, datetime.timezone.utc).date()
+    return day.isoformat() + SEGMENT_SUFFIX
+
+
+class TimeSeriesStore(object):
+    """
+    Appends readings to and reads ranges from the store in `directory`.
+    Appended records are buffered in `buffer_size` bytes until `flush`.
+    """
+    def __init__(self, directory, buffer_size=65536):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        os.makedirs(directory, exist_ok=True)
+        self._names = []
+        self._indexes = {}
+        self._load_names()
+        self._fh = None
+        self._segment = None
+
+    def _load_names(self):
+        try:
+            with open(os.path.join(self.directory, SENSORS_FILE), 'r') as fh:
+                self._names = fh.read().splitlines()
+        except FileNotFoundError:
+            self._names = []
+        self._indexes = {
+            name: index for index, name in enumerate(self._names)}
+
+    def names(self):
+        return list(self._names)
+
+    def sensor_index(self, name):
+        """Index of sensor `name`, adding it to the store if it is new."""
+        index = self._indexes.get(name)
+        if index is not None:
+            return index
+        if '\n' in name:
+            raise StoreError('Invalid sensor name {!r}'.format(name))
+        if len(self._names) > numpy.iinfo(RECORD['sensor']).max:
+            raise StoreError('Too many sensors in {}'.format(self.directory))
+
+        with open(os.path.join(self.directory, SENSORS_FILE), 'a') as fh:
+            fh.write(name + '\n')
+        index = len(self._names)
+        self._names.append(name)
+        self._indexes[name] = index
+        return index
+
+    def segments(self):
+        """(day start, path) of every segment, oldest first."""
+        segments = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(SEGMENT_SUFFIX):
+                continue
+            day = datetime.datetime.strptime(
+                filename[:-len(SEGMENT_SUFFIX)], '%Y-%m-%d').replace(
+                    tzinfo=datetime.timezone.utc)
+            segments.append((int(day.timestamp() * 1000),
+                             os.path.join(self.directory, filename)))
+
+        return segments
+
+    def _open_segment(self, start):
+        self.close()
+        path = os.path.join(self.directory, segment_name(start))
+        self._fh = open(path, 'ab', buffering=self.buffer_size)
+        size = self._fh.tell()
+        if not size:
+            self._fh.write(HEADER.pack(MAGIC, VERSION, RECORD.itemsize, start))
+        elif (size - HEADER.size) % RECORD.itemsize:
+            # drop a record left incomplete by a crash
+            self._fh.truncate(size - (size - HEADER.size) % RECORD.itemsize)
+        self._segment = start
+
+    def append(self, name, timestamp, value):
+        """Stores `value` (degrees) of sensor `name` taken at `timestamp`."""
+        start = day_start(timestamp)
+        if start != self._segment:
+            self._open_segment(start)
+        self._fh.write(struct.pack(
+            '<qHi', timestamp, self.sensor_index(name),
+            int(round(value * 1000))))
+
+    def flush(self):
+        if self._fh is not None:
+            self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+            self._segment = None
+
+    def read_segment(self, path):
+        """All records of one segment as a read-only memory-mapped array."""
+        with open(path, 'rb') as fh:
+            header = fh.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return numpy.zeros(0, dtype=RECORD)
+        magic, version, record_size, _ = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or \
+                record_size != RECORD.itemsize:
+            raise StoreError('{} is not a version {} segment'.format(
+                path, VERSION))
+
+        count = (os.path.getsize(path) - HEADER.size) // RECORD.itemsize
+        if not count:
+            return numpy.zeros(0, dtype=RECORD)
+        return numpy.memmap(path, dtype=RECORD, mode='r',
+                            offset=HEADER.size, shape=(count,))
+
+    def read(self, start=None, end=None, names=None):
+        """
+        Records taken from `start` up to `end` (milliseconds; None is
+        unbounded) of the sensors in `names` (None is all), as one structured
+        array with 'timestamp', 'sensor' and 'value' (milli-degrees) fields.
+        """
+        self.flush()
+        self._load_names()
+        sensors = None
+        if names is not None:
+            sensors = [self._indexes[name] for name in names
+                       if name in self._indexes]
+
+        parts = []
+        for segment_start, path in self.segments():
+            if end is not None and segment_start >= end:
+                break
+            if start is not None and segment_start + DAY <= start:
+                continue
+
+            records = self.read_segment(path)
+            mask = None
+            if start is not None and segment_start < start:
+                mask = records['timestamp'] >= start
+            if end is not None and segment_start + DAY > end:
+                in_range = records['timestamp'] < end
+                mask = in_range if mask is None else mask & in_range
+            if sensors is not None:
+                selected = numpy.isin(records['sensor'], sensors)
+                mask = selected if mask is None else mask & selected
+            parts.append(records if mask is None else records[mask])
+
+        if not parts:
+            return numpy.zeros(0, dtype=RECORD)
+        return numpy.concatenate(parts)
+
+
+def import_csv(store, filename):
+    count = 0
+    with open(filename, 'r') as fh:
+        for line in fh:
+            parsed = parse_csv_line(line)
+            if parsed is None:
+                if line.strip():
+                    log.warning('Skipped malformed line in {}: {!r}'.format(
+                        filename, line))
+                continue
+            store.append(*parsed)
+            count += 1
+    store.flush()
+
+    return count
+
+
+def print_records(store, records):
+    names = store.names()
+    for timestamp, sensor, value in records.tolist():
+        print('{},{}={}'.format(
+            datetime.datetime.fromtimestamp(timestamp / 1000).isoformat(),
+            names[sensor], value / 1000))
+
+
+def print_summary(store, records):
+    names = store.names()
+    for sensor in numpy.unique(records['sensor']):
+        values = records['value'][records['sensor'] == sensor] / 1000
+        print('{}: count={} min={} mean={:.3f} max={}'.format(
+            names[sensor], len(values), values.min(), values.mean(),
+            values.max()))
+
+
+if __name__ == "__main__":
+    options = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO)
+
+    store = TimeSeriesStore(options['<directory>'])
+    if options['import']:
+        for filename in options['<csv>']:
+            log.info('Imported {} readings from {}'.format(
+                import_csv(store, filename), filename))
+        store.close()
+        sys.exit(0)
+
+    start = end = None
+    if options['--start']:
+        start = to_timestamp(options['--start'])
+    if options['--end']:
+        end = to_timestamp(options['--end'])
+    records = store.read(start, end, options['-s'] or None)
+    if options['--summary']:
+        print_summary(store, records)
+    else:
+        print_records(store, records)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Discovery, bookkeeping and reading of 1-Wire temperature sensors.
+
+Two reader engines share one interface, `discover()` returning sensor
+objects with an `id` and `read(handle)` returning a temperature in the scale
+configured for the sensor:
+
+* W1ThermSensorReader wraps the w1thermsensor package;
+* SysfsReader reads the kernel's sysfs attributes directly.
+"""
+import errno
+import logging
+import os
+import time
+
+from aggregate import DEFAULT_HEARTBEAT, SensorAggregator
+from lineprotocol import SensorEncoder
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+log = logging.getLogger(__name__)
+
+W1_DEVICES_PATH = '/sys/bus/w1/devices'
+# family codes of DS18S20, DS1822, DS18B20, DS1825 and MAX31850K sensors
+THERM_FAMILIES = ('10', '22', '28', '3b', '42')
+# millidegrees Celsius to each scale, indexed like lineprotocol.SCALES
+CONVERSIONS = (
+    lambda millidegrees: millidegrees / 1000.0,
+    lambda millidegrees: millidegrees * 0.0018 + 32,
+    lambda millidegrees: millidegrees / 1000.0 + 273.15,
+)
+# sensors.yaml attributes that configure collection instead of tagging readings
+SETTINGS = ('interval', 'window', 'deadband', 'heartbeat')
+
+
+class SensorReadError(Exception):
+    pass
+
+
+class CRCError(SensorReadError):
+    pass
+
+
+class SensorHandle(object):
+    """
+    A discovered sensor together with its metadata from sensors.yaml and the
+    line-protocol encoder built from it.
+    """
+    def __init__(self, sensor, metadata, default_interval=1):
+        self.sensor = sensor
+        self.id = sensor.id
+        self.metadata = metadata
+        self.tags = {name: value for name, value in metadata.items()
+                     if name not in SETTINGS}
+        self.interval = float(metadata.get('interval', default_interval))
+        self.encoder = SensorEncoder(self.id, self.tags)
+        self.aggregator = SensorAggregator(
+            self.encoder, window=metadata.get('window', 0),
+            deadband=metadata.get('deadband', 0),
+            heartbeat=metadata.get('heartbeat', DEFAULT_HEARTBEAT))
+
+    def __repr__(self):
+        return 'SensorHandle({})'.format(self.id)
+
+
+class DevicesWatcher(object):
+    """
+    Reports additions and removals in the w1 devices directory through
+    inotify. Without the optional inotify_simple package, or when the kernel
+    refuses the watch, `changed` is always False and callers rely on periodic
+    rescans instead.
+    """
+    def __init__(self, path=W1_DEVICES_PATH):
+        self._inotify = None
+        if inotify_simple is None:
+            log.info('inotify_simple not found; `pip install inotify_simple` '
+                     'to detect sensor changes without waiting for a rescan.')
+            return
+
+        try:
+            self._inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            self._inotify.add_watch(
+                path, flags.CREATE | flags.DELETE | flags.MOVED_FROM |
+                flags.MOVED_TO)
+        except OSError as e:
+            log.warning('Could not watch {path}: {e}'.format(**locals()))
+            self._inotify = None
+
+    def changed(self):
+        if self._inotify is None:
+            return False
+        return bool(self._inotify.read(timeout=0))
+
+
+class SensorRegistry(object):
+    """
+    Keeps the list of available sensors between collection cycles.
+
+    `discover` is a callable returning sensor objects with an `id` attribute,
+    e.g. W1ThermSensor.get_available_sensors. It is called once on creation
+    and again every `refresh_interval` seconds, or as soon as `watcher`
+    reports a change to the devices directory.
+    """
+    def __init__(self, discover, all_metadata, refresh_interval=60,
+                 watcher=None, default_interval=1):
+        self.discover = discover
+        self.all_metadata = all_metadata
+        self.default_interval = default_interval
+        self.refresh_interval = refresh_interval
+        self.watcher = watcher
+        self._handles = {}
+        self._sensors = []
+        self._refreshed_at = None
+        self.refresh()
+
+    def refresh(self):
+        found = {}
+        for sensor in self.discover():
+            handle = self._handles.get(sensor.id)
+            if handle is None:
+                handle = SensorHandle(
+                    sensor, self.all_metadata.get(sensor.id, {}),
+                    self.default_interval)
+                log.info('Sensor "{}" found.'.format(sensor.id))
+            found[sensor.id] = handle
+
+        for sensor_id in self._handles.keys() - found.keys():
+            log.warning('Sensor "{}" is no longer available.'.format(
+                sensor_id))
+
+        self._handles = found
+        self._sensors = list(found.values())
+        self._refreshed_at = time.monotonic()
+
+    def is_stale(self):
+        if self.watcher is not None and self.watcher.changed():
+            return True
+        elapsed = time.monotonic() - self._refreshed_at
+        return elapsed >= self.refresh_interval
+
+    def sensors(self):
+        if self.is_stale():
+            self.refresh()
+        return self._sensors
+
+
+class W1ThermSensorReader(object):
+    """Reads sensors through a w1thermsensor.W1ThermSensor client."""
+    def __init__(self, w1client):
+        from w1thermsensor.errors import (
+            SensorNotReadyError, W1ThermSensorError)
+        self.w1client = w1client
+        self.errors = W1ThermSensorError
+        # raised when the w1_slave CRC line does not end in YES
+        self.crc_errors = SensorNotReadyError
+        self.units = (w1client.DEGREES_C, w1client.DEGREES_F,
+                      w1client.KELVIN)
+
+    def discover(self):
+        return self.w1client.get_available_sensors()
+
+    def read(self, handle):
+        try:
+            return handle.sensor.get_temperature(
+                self.units[handle.encoder.scale_index])
+        except self.crc_errors as e:
+            raise CRCError(str(e))
+        except self.errors as e:
+            raise SensorReadError(str(e))
+
+
+class SysfsSensor(object):
+    """
+    A thermometer in the w1 sysfs tree. Kernels from 5.x expose the reading
+    in millidegrees as `temperature`; older ones only have `w1_slave`, e.g.:
+
+    72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+    72 01 4b 46 7f ff 0e 10 57 t=23125
+    """
+    def __init__(self, device_path):
+        self.device_path = device_path
+        self.id = os.path.basename(device_path).split('-', 1)[1]
+        self.path = os.path.join(device_path, 'temperature')
+        self.has_temperature = os.path.exists(self.path)
+        if not self.has_temperature:
+            self.path = os.path.join(device_path, 'w1_slave')
+
+    def __repr__(self):
+        return 'SysfsSensor({})'.format(self.device_path)
+
+    def read_millidegrees(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                data = os.read(fd, 256)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            # the temperature attribute reports CRC failures as EIO; other
+            # errors, such as an unplugged sensor, are not worth a retry
+            if self.has_temperature and e.errno == errno.EIO:
+                raise CRCError('{}: {}'.format(self.path, e))
+            raise SensorReadError('{}: {}'.format(self.path, e))
+
+        if self.has_temperature:
+            try:
+                return int(data)
+            except ValueError:
+                raise SensorReadError('{}: unexpected data {!r}'.format(
+                    self.path, data))
+
+        crc_line, _, data_line = data.partition(b'\n')
+        if not crc_line.endswith(b'YES'):
+            raise CRCError('{}: CRC check failed'.format(self.path))
+        _, found, raw = data_line.rpartition(b't=')
+        if not found:
+            raise SensorReadError('{}: unexpected data {!r}'.format(
+                self.path, data))
+
+        return int(raw)
+
+
+class SysfsReader(object):
+    """
+    Reads sensors straight from sysfs with a single read per attempt,
+    retrying up to `retries` times on CRC errors, and only converts to the
+    scale configured for each sensor.
+    """
+    def __init__(self, devices_path=W1_DEVICES_PATH, retries=2):
+        self.devices_path = devices_path
+        self.retries = retries
+
+    def discover(self):
+        try:
+            names = os.listdir(self.devices_path)
+        except FileNotFoundError:
+            log.error('{} not found; is the w1-gpio kernel module '
+                      'loaded?'.format(self.devices_path))
+            return []
+
+        return [SysfsSensor(os.path.join(self.devices_path, name))
+                for name in sorted(names)
+                if name.split('-', 1)[0] in THERM_FAMILIES and '-' in name]
+
+    def read(self, handle):
+        attempt = 0
+        while True:
+            try:
+                millidegrees = handle.sensor.read_millidegrees()
+                break
+            except CRCError as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log.debug('{}; retrying'.format(e))
+
+        return CONVERSIONS[handle.encoder.scale_index](millidegrees)